@@ -5,6 +5,7 @@ CREATE TABLE IF NOT EXISTS rclass (
     rclass_id INT,
     PRIMARY KEY (rclass_id),
 
+    CHECK(rclass_id BETWEEN 100 AND 599 AND rclass_id % 100 < 10),  -- NB: So rclass_bit() fits in a BIGINT
     name TEXT NOT NULL,
     CHECK(name ~ '^[A-Za-z0-9_.]+$'),
     description TEXT NOT NULL
@@ -14,6 +15,13 @@ COMMENT ON COLUMN rclass.name IS 'Machine-readable name for class, meet LTREE re
 COMMENT ON COLUMN rclass.description IS 'Description for region class, define rvalue';
 
 
+CREATE OR REPLACE FUNCTION rclass_bit(rclass_id INT) RETURNS BIGINT AS
+$BODY$
+    SELECT 1::BIGINT << ((rclass_id / 100) * 10 + rclass_id % 100);
+$BODY$ LANGUAGE sql IMMUTABLE;
+COMMENT ON FUNCTION rclass_bit(rclass_id INT) IS 'Bit representing (rclass_id) in token.part_of';
+
+
 /* Populate vocabulary */
 CREATE OR REPLACE FUNCTION pg_temp.upsert_rclass(new_id INT, new_name TEXT, new_description TEXT) RETURNS VOID AS
 $BODY$
@@ -31,14 +31,24 @@ CREATE TABLE IF NOT EXISTS token (
     PRIMARY KEY (book_id, crange),
 
     ttype TEXT NOT NULL,
+    ttext TEXT NOT NULL,
+    separator TEXT[] NOT NULL CHECK (ARRAY_LENGTH(separator, 1) = 3),
     ordering INT NULL,
-    part_of JSONB NULL  -- NB: Ideally this would be NOT NULL DEFERRABLE but you can't do that yet
+    part_of BIGINT NULL,  -- NB: Ideally this would be NOT NULL DEFERRABLE but you can't do that yet
+    chapter INT NULL,
+    paragraph INT NULL,
+    sentence INT NULL
 );
 COMMENT ON TABLE  token IS $$Tokens within a book (partition root: each book gets it's own sub-table)$$;
 COMMENT ON COLUMN token.ttype IS 'Token type, i.e. normalised token';
 COMMENT ON COLUMN token.crange IS 'Character range to find this token at';
+COMMENT ON COLUMN token.ttext IS 'Token text, as it appears in the book';
+COMMENT ON COLUMN token.separator IS 'Text between this and the next token, split at the first whitespace into (before, whitespace, after)';
 COMMENT ON COLUMN token.ordering IS 'Position of this token within book (populated by book_import_finalise)';
-COMMENT ON COLUMN token.part_of IS 'Dict of all regions this token is part of (populated by book_import_finalise)';
+COMMENT ON COLUMN token.part_of IS 'Bitmask of the rclasses of all regions this token is part of, see rclass_bit() (populated by book_import_finalise)';
+COMMENT ON COLUMN token.chapter IS 'Chapter number this token is part of (populated by book_import_finalise)';
+COMMENT ON COLUMN token.paragraph IS 'Paragraph number within chapter this token is part of (populated by book_import_finalise)';
+COMMENT ON COLUMN token.sentence IS 'Sentence number within chapter this token is part of (populated by book_import_finalise)';
 
 
 CREATE TABLE IF NOT EXISTS region (
@@ -49,11 +59,15 @@ CREATE TABLE IF NOT EXISTS region (
     crange INT4RANGE NOT NULL CHECK (UPPER(crange) > LOWER(crange)),
     PRIMARY KEY (book_id, rclass_id, crange),
 
-    rvalue INT NULL
+    rvalue INT NULL,
+    first_ordering INT NULL,
+    last_ordering INT NULL
 );
 COMMENT ON TABLE  region IS $$Regions within a book (partition root: each book gets it's own sub-table)$$;
 COMMENT ON COLUMN region.rvalue IS 'Value associated with range, e.g. chapter number';
 COMMENT ON COLUMN region.crange IS 'Character range this applies to';
+COMMENT ON COLUMN region.first_ordering IS 'token.ordering of first token within region, NULL if none (populated by book_import_finalise)';
+COMMENT ON COLUMN region.last_ordering IS 'token.ordering of last token within region, NULL if none (populated by book_import_finalise)';
 
 
 CREATE TABLE IF NOT EXISTS book_metadata (
@@ -82,6 +96,52 @@ COMMENT ON COLUMN book_word_count.word_count IS 'Number of words in region (popu
 COMMENT ON TABLE book_word_count IS 'Count words within a selection of regions';
 
 
+CREATE TABLE IF NOT EXISTS book_ngram (
+    book_id INT NOT NULL,
+    FOREIGN KEY (book_id) REFERENCES book(book_id),
+    rclass_id INT NOT NULL,
+    FOREIGN KEY (rclass_id) REFERENCES rclass(rclass_id),
+    ngram_length INT NOT NULL,
+    ngram TEXT NOT NULL,
+    PRIMARY KEY (book_id, rclass_id, ngram_length, ngram),
+
+    ngram_count INT NOT NULL
+);
+COMMENT ON TABLE book_ngram IS 'Frequency of each cluster of 1..5 types within a selection of regions';
+COMMENT ON COLUMN book_ngram.ngram IS 'Space-separated types in the cluster';
+COMMENT ON COLUMN book_ngram.ngram_count IS 'Number of times cluster occurs in region (populated by book_import_finalise)';
+
+
+CREATE TABLE IF NOT EXISTS lexicon (
+    ttype_id SERIAL,
+    PRIMARY KEY (ttype_id),
+
+    ttype TEXT NOT NULL,
+    UNIQUE (ttype)
+);
+COMMENT ON TABLE lexicon IS 'All distinct types in all books (populated by book_import_finalise)';
+COMMENT ON COLUMN lexicon.ttype IS 'Token type, i.e. normalised token';
+CREATE INDEX IF NOT EXISTS trgm_lexicon_ttype ON lexicon USING GIN (ttype gin_trgm_ops);
+COMMENT ON INDEX trgm_lexicon_ttype IS 'Expand partial types in concordance queries';
+
+
+CREATE TABLE IF NOT EXISTS book_ttype (
+    book_id INT NOT NULL,
+    FOREIGN KEY (book_id) REFERENCES book(book_id),
+    rclass_id INT NOT NULL,
+    FOREIGN KEY (rclass_id) REFERENCES rclass(rclass_id),
+    ttype_id INT NOT NULL,
+    FOREIGN KEY (ttype_id) REFERENCES lexicon(ttype_id),
+    PRIMARY KEY (book_id, rclass_id, ttype_id),
+
+    ttype_count INT NOT NULL,
+    orderings INT[] NOT NULL
+);
+COMMENT ON TABLE book_ttype IS 'Frequency & positions of each type within a selection of regions';
+COMMENT ON COLUMN book_ttype.ttype_count IS 'Number of tokens of this type in region (populated by book_import_finalise)';
+COMMENT ON COLUMN book_ttype.orderings IS 'Sorted token.ordering of each token of this type in region (populated by book_import_finalise)';
+
+
 CREATE OR REPLACE FUNCTION book_import_init(new_name TEXT, new_content TEXT) RETURNS TABLE(
     book_id INT,
     token_tbl TEXT,
@@ -123,6 +183,8 @@ BEGIN
     -- Empty metadata tables from any previous versions of book
     DELETE FROM book_metadata bm WHERE bm.book_id = new_book_id;
     DELETE FROM book_word_count bwc WHERE bwc.book_id = new_book_id;
+    DELETE FROM book_ttype bt WHERE bt.book_id = new_book_id;
+    DELETE FROM book_ngram bn WHERE bn.book_id = new_book_id;
 
     RETURN QUERY SELECT new_book_id, token_tbl, region_tbl;
 END;
@@ -138,6 +200,7 @@ DECLARE
     token_tbl TEXT;
     region_tbl TEXT;
     t TEXT;
+    n INT;
 BEGIN
     token_tbl = 'token_' || new_book_id;
     region_tbl = 'region_' || new_book_id;
@@ -148,8 +211,9 @@ BEGIN
         EXECUTE format($$COMMENT ON INDEX %1$s_rclass_id IS 'Get regions by rclass'$$, t);
         EXECUTE format($$CREATE INDEX IF NOT EXISTS gist_%1$s_book_id_crange ON %1$s USING GIST (book_id, crange)$$, t);
         EXECUTE format($$COMMENT ON INDEX gist_%1$s_book_id_crange IS 'Finding regions in a range, joining to tokens'$$, t);
-        EXECUTE format($$CREATE INDEX IF NOT EXISTS %1$s_book_id_lower_crange ON %1$s (book_id, LOWER(crange))$$, t);
-        EXECUTE format($$COMMENT ON INDEX %1$s_book_id_lower_crange IS 'Sorting on LOWER(crange)'$$, t);
+        EXECUTE format($$DROP INDEX IF EXISTS %1$s_book_id_lower_crange$$, t);  -- NB: Superseded by the index below
+        EXECUTE format($$CREATE INDEX IF NOT EXISTS %1$s_book_id_lower_crange_rclass_id ON %1$s (book_id, LOWER(crange), rclass_id)$$, t);
+        EXECUTE format($$COMMENT ON INDEX %1$s_book_id_lower_crange_rclass_id IS 'Sorting on LOWER(crange), paging through regions in book order'$$, t);
     END LOOP;
 
     -- Index token partition
@@ -172,13 +236,43 @@ BEGIN
         )
         UPDATE %1$s t
            SET ordering = o.ordering
-             , part_of = (SELECT JSONB_OBJECT_AGG(r.rclass_id, r.rvalue) FROM region r WHERE t.book_id = r.book_id AND t.crange <@ r.crange)
+             , (part_of, chapter, paragraph, sentence) = (
+                   SELECT COALESCE(BIT_OR(rclass_bit(r.rclass_id)), 0)
+                        , MAX(r.rvalue) FILTER (WHERE rc.name = 'chapter.text')
+                        , MAX(r.rvalue) FILTER (WHERE rc.name = 'chapter.paragraph')
+                        , MAX(r.rvalue) FILTER (WHERE rc.name = 'chapter.sentence')
+                     FROM region r, rclass rc
+                    WHERE t.book_id = r.book_id
+                      AND t.crange <@ r.crange
+                      AND r.rclass_id = rc.rclass_id)
           FROM token_ordering o
          WHERE t.book_id = o.book_id
            AND t.crange = o.crange
            AND t.book_id = %2$s
     $$, token_tbl, new_book_id);
 
+    -- Store token boundaries of each region
+    EXECUTE format($$
+        UPDATE %1$s r
+           SET first_ordering = o.first_ordering
+             , last_ordering = o.last_ordering
+          FROM (
+            SELECT r.book_id
+                 , r.rclass_id
+                 , r.crange
+                 , MIN(t.ordering) first_ordering
+                 , MAX(t.ordering) last_ordering
+              FROM %1$s r, token t
+             WHERE t.book_id = r.book_id
+               AND t.crange <@ r.crange
+               AND r.book_id = %2$s
+          GROUP BY r.book_id, r.rclass_id, r.crange
+               ) o
+         WHERE r.book_id = o.book_id
+           AND r.rclass_id = o.rclass_id
+           AND r.crange = o.crange
+    $$, region_tbl, new_book_id);
+
     -- Update book metadata tables
     INSERT INTO book_metadata (book_id, rclass_id, rvalue, content)
          SELECT r.book_id
@@ -212,13 +306,61 @@ BEGIN
                     'quote.nonquote',
                     'quote.suspension.short',
                     'quote.suspension.long');
+    INSERT INTO lexicon (ttype)
+         SELECT DISTINCT t.ttype
+           FROM token t
+          WHERE t.book_id = new_book_id
+    ON CONFLICT (ttype) DO NOTHING;
+    INSERT INTO book_ttype (book_id, rclass_id, ttype_id, ttype_count, orderings)
+         SELECT t.book_id
+              , rc.rclass_id
+              , l.ttype_id
+              , COUNT(*) ttype_count
+              , ARRAY_AGG(t.ordering ORDER BY t.ordering) orderings
+           FROM token t, rclass rc, lexicon l
+          WHERE t.book_id = new_book_id
+            AND (t.part_of & rclass_bit(rc.rclass_id)) <> 0
+            AND t.ttype = l.ttype
+            AND rc.name IN (
+                    'chapter.text',
+                    'quote.quote',
+                    'quote.nonquote',
+                    'quote.suspension.short',
+                    'quote.suspension.long')
+       GROUP BY t.book_id, rc.rclass_id, l.ttype_id;
+    -- NB: Clusters are contiguous tokens within the region, see clic.cluster
+    FOR n IN 1..5 LOOP
+        INSERT INTO book_ngram (book_id, rclass_id, ngram_length, ngram, ngram_count)
+             SELECT new_book_id
+                  , all_ngrams.rclass_id
+                  , n
+                  , all_ngrams.ngram
+                  , COUNT(*) ngram_count
+               FROM (
+                 SELECT rc.rclass_id
+                      , CASE WHEN MAX(t.ordering) OVER ngram - MIN(t.ordering) OVER ngram = n - 1
+                              AND COUNT(t.ttype) OVER ngram = n
+                             THEN STRING_AGG(t.ttype, ' ') OVER ngram
+                              END ngram
+                   FROM token t, rclass rc
+                  WHERE t.book_id = new_book_id
+                    AND (t.part_of & rclass_bit(rc.rclass_id)) <> 0
+                    AND rc.name IN (
+                            'chapter.text',
+                            'quote.quote',
+                            'quote.nonquote',
+                            'quote.suspension.short',
+                            'quote.suspension.long')
+                 WINDOW ngram AS (PARTITION BY rc.rclass_id ORDER BY t.ordering ROWS BETWEEN n - 1 PRECEDING AND CURRENT ROW)
+                    ) all_ngrams
+              WHERE all_ngrams.ngram IS NOT NULL
+           GROUP BY all_ngrams.rclass_id, all_ngrams.ngram;
+    END LOOP;
 
     -- Add our indexes to the extra metadata
     FOREACH t IN ARRAY array['token', token_tbl] LOOP
         EXECUTE format($$CREATE UNIQUE INDEX IF NOT EXISTS unique_%1$s_book_id_ordering ON %1$s (book_id, ordering)$$, t);
         EXECUTE format($$COMMENT ON INDEX unique_%1$s_book_id_ordering IS 'Selecting tokens around a point in concordance'$$, t);
-        EXECUTE format($$CREATE INDEX IF NOT EXISTS trgm_%1$s_book_id_ttype_part_of ON %1$s USING GIN (book_id, ttype gin_trgm_ops, part_of)$$, t);
-        EXECUTE format($$COMMENT ON INDEX trgm_%1$s_book_id_ttype_part_of IS 'Select tokens by partial types & part_of regions in concorcance'$$, t);
     END LOOP;
 END;
 $BODY$ LANGUAGE 'plpgsql' SECURITY DEFINER;
@@ -7,9 +7,11 @@ import datetime
 from flask import Flask, request, Response, jsonify, g, stream_with_context
 from flask_cors import CORS
 
+import clic.collocation
 import clic.concordance
 import clic.cluster
 import clic.count
+import clic.distribution
 import clic.metadata
 import clic.keyword
 import clic.subset
@@ -23,9 +25,12 @@ from clic.stream_json import stream_json, format_error, JSONEncoder
 # API endpoint functions and their view type (see to_view_func)
 API_ENDPOINTS = [
     (clic.cluster.cluster, 'stream'),
+    (clic.collocation.collocation, 'stream'),
     (clic.concordance.concordance, 'stream'),
     (clic.count.count, 'stream'),
+    (clic.distribution.distribution, 'stream'),
     (clic.keyword.keyword, 'stream'),
+    (clic.keyword.keyword_matrix, 'stream'),
     (clic.subset.subset, 'stream'),
     (clic.text.text, 'stream'),
     (clic.metadata.corpora, 'json'),
@@ -118,13 +123,19 @@ def to_view_func(fn, output_mode):
 
     def stream_view_func():
         out = fn(g.cur, **get_args(request))
+        header = dict(version=g.clic_versions)
         # NB: We need stream_with_context() to make sure the database stays open
-        out = stream_with_context(stream_json(out, dict(version=g.clic_versions), cls=JSONEncoder))
+        out = stream_with_context(stream_json(out, header, cls=JSONEncoder))
 
         # Consume nonsense item, so we know generator is ready to output a header, and any
         # initial errors cause a 500 response
         assert(next(out) is None)
-        return Response(out, content_type='application/json')
+        response = Response(out, content_type='application/json')
+
+        # Copy any estimates into HTTP headers, so clients can read them before the response arrives
+        if 'estimated_hits' in header:
+            response.headers['X-Estimated-Hits'] = str(header['estimated_hits'])
+        return response
     if output_mode == 'stream':
         view_func = stream_view_func
 
@@ -0,0 +1,258 @@
+"""
+clic.cache: Shared on-disk cache
+********************************
+
+Some data (e.g. book contents) is expensive to fetch from the database, but
+changes rarely. This module stores files in a directory shared between all
+worker processes, so each only needs fetching once.
+
+The directory is set by the ``CACHE_DIR`` environment variable, and defaults to
+``clic-cache`` in the system's temporary directory. Once the directory uses
+more than ``CACHE_SIZE`` bytes (default 1GiB), the least recently used files
+are removed.
+
+cache_file
+==========
+
+Given a key, we get an open file for it. If the file doesn't exist yet, the
+function provided is called to write it::
+
+    >>> import os, shutil, tempfile
+    >>> old_cache_dir = os.environ.get('CACHE_DIR')
+    >>> os.environ['CACHE_DIR'] = tempfile.mkdtemp()
+    >>> def write_content(f):
+    ...     print("Writing file")
+    ...     f.write('Hello, wörld'.encode('utf8'))
+    >>> with cache_file(('ut_cache', 1), write_content) as f:
+    ...     f.read().decode('utf8')
+    Writing file
+    'Hello, wörld'
+    >>> with cache_file(('ut_cache', 1), write_content) as f:
+    ...     f.read().decode('utf8')
+    'Hello, wörld'
+
+The file lives at ``cache_path(key)``::
+
+    >>> path = cache_path(('ut_cache', 1))
+    >>> os.path.exists(path)
+    True
+
+cache_evict
+===========
+
+When the cache is too large, the least recently used files are removed::
+
+    >>> paths = []
+    >>> for i in range(5):
+    ...     with cache_file(('ut_evict', i), lambda f: f.write(b'x' * 100)):
+    ...         paths.append(cache_path(('ut_evict', i)))
+    >>> for i, p in enumerate(paths):
+    ...     os.utime(p, (i, i))
+    >>> os.environ['CACHE_SIZE'] = '300'
+    >>> cache_evict()
+    >>> [os.path.exists(p) for p in paths]
+    [False, False, False, True, True]
+    >>> os.path.exists(path)
+    True
+
+A file bigger than the whole cache is evicted straight away, but since it's
+opened first we can still read it::
+
+    >>> os.environ['CACHE_SIZE'] = '50'
+    >>> with cache_file(('ut_evict', 'big'), lambda f: f.write(b'y' * 100)) as f:
+    ...     len(f.read())
+    100
+    >>> os.path.exists(cache_path(('ut_evict', 'big')))
+    False
+    >>> del os.environ['CACHE_SIZE']
+
+Afterwards we remove our cache directory, and put CACHE_DIR back::
+
+    >>> shutil.rmtree(os.environ['CACHE_DIR'])
+    >>> if old_cache_dir is None:
+    ...     del os.environ['CACHE_DIR']
+    ... else:
+    ...     os.environ['CACHE_DIR'] = old_cache_dir
+
+LRUCache
+========
+
+Each process can also keep the most recently used few things in memory. Values
+are only created when they're not already there::
+
+    >>> lru = LRUCache(2)
+    >>> lru.get(('ut_lru', 1), lambda: print("Creating 1") or 'one')
+    Creating 1
+    'one'
+    >>> lru.get(('ut_lru', 2), lambda: print("Creating 2") or 'two')
+    Creating 2
+    'two'
+    >>> lru.get(('ut_lru', 1), lambda: print("Creating 1") or 'one')
+    'one'
+
+...and the least recently used are forgotten once there are too many::
+
+    >>> lru.get(('ut_lru', 3), lambda: print("Creating 3") or 'three')
+    Creating 3
+    'three'
+    >>> lru.get(('ut_lru', 2), lambda: print("Creating 2") or 'two')
+    Creating 2
+    'two'
+    >>> lru.get(('ut_lru', 1), lambda: print("Creating 1") or 'one')
+    Creating 1
+    'one'
+
+Values can have a size, in which case we keep as many as will fit. A value too
+big to fit is returned, but not kept::
+
+    >>> lru = LRUCache(10, size_fn=len)
+    >>> lru.get(('ut_lru', 'a'), lambda: print("Creating a") or 'aaaa')
+    Creating a
+    'aaaa'
+    >>> lru.get(('ut_lru', 'b'), lambda: print("Creating b") or 'bbbbbb')
+    Creating b
+    'bbbbbb'
+    >>> lru.get(('ut_lru', 'a'), lambda: print("Creating a") or 'aaaa')
+    'aaaa'
+    >>> lru.get(('ut_lru', 'c'), lambda: print("Creating c") or 'cc')
+    Creating c
+    'cc'
+    >>> lru.get(('ut_lru', 'b'), lambda: print("Creating b") or 'bbbbbb')
+    Creating b
+    'bbbbbb'
+    >>> lru.get(('ut_lru', 'z'), lambda: print("Creating z") or 'z' * 20)
+    Creating z
+    'zzzzzzzzzzzzzzzzzzzz'
+    >>> lru.get(('ut_lru', 'z'), lambda: print("Creating z") or 'z' * 20)
+    Creating z
+    'zzzzzzzzzzzzzzzzzzzz'
+"""
+import collections
+import hashlib
+import os
+import os.path
+import tempfile
+import threading
+
+#: Default maximum size of cache directory, in bytes
+DEFAULT_CACHE_SIZE = 1024 ** 3
+
+
+def cache_dir():
+    """Directory the cache lives in"""
+    return os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'clic-cache'))
+
+
+def cache_path(key):
+    """Path to the cache file for (key), which may not exist"""
+    return os.path.join(cache_dir(), hashlib.sha1(repr(key).encode('utf8')).hexdigest())
+
+
+def cache_file(key, write_fn):
+    """
+    Return an open binary file for (key), creating it if necessary.
+
+    - key: A tuple of values that identify the file, including anything that
+      would mean the content has changed (e.g. corpora version)
+    - write_fn: Function that, given a binary file object, writes the content
+
+    The file is opened before anything is evicted, so it can be read even if
+    it (or another process) evicts it straight away.
+    """
+    path = cache_path(key)
+
+    try:
+        f = open(path, 'rb')
+        os.utime(f.fileno())  # Mark as recently used
+        return f
+    except FileNotFoundError:
+        pass
+
+    # Write to temporary file first, so other processes never see a partial file
+    os.makedirs(cache_dir(), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir(), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_fn(f)
+        f = open(tmp_path, 'rb')
+        os.replace(tmp_path, path)
+    except:  # noqa
+        os.unlink(tmp_path)
+        raise
+
+    cache_evict()
+    return f
+
+
+def cache_evict():
+    """
+    Remove least-recently used files from the cache until it is under CACHE_SIZE
+    """
+    max_size = int(os.environ.get('CACHE_SIZE', DEFAULT_CACHE_SIZE))
+    entries = []
+    total = 0
+    for e in os.scandir(cache_dir()):
+        if e.name.startswith('.tmp-'):
+            continue  # Another process is writing this
+        try:
+            st = e.stat()
+        except FileNotFoundError:
+            continue  # Another process evicted this
+        entries.append((st.st_mtime, st.st_size, e.path))
+        total += st.st_size
+
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+class LRUCache():
+    """
+    In-memory store of the most recently used values, safe to share between
+    threads. Values are forgotten once their sizes add up to more than
+    (max_size), where a value's size is size_fn(value), or 1 if not given.
+    Use the same keys as cache_file(), so values are forgotten when their
+    content changes.
+    """
+    def __init__(self, max_size, size_fn=None):
+        self.max_size = max_size
+        self.size_fn = size_fn or (lambda value: 1)
+        self._values = collections.OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, create_fn):
+        """Return the value for (key), calling create_fn() to make it if we don't have it"""
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                return self._values[key][0]
+
+        # NB: Not holding the lock, so other threads can carry on whilst we create
+        value = create_fn()
+
+        size = self.size_fn(value)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = (value, size)
+                self._total += size
+            while self._total > self.max_size:
+                _, (_, old_size) = self._values.popitem(last=False)
+                self._total -= old_size
+        return value
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._values
+
+    def clear(self):
+        """Forget all values"""
+        with self._lock:
+            self._values.clear()
+            self._total = 0
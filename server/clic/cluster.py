@@ -8,6 +8,8 @@ Return a list of word clusters, and their frequency within the given texts.
 - subset: subset to search through, one of shortsus/longsus/nonquote/quote/all. Default 'all' (i.e. all text)
 - clusterlength: cluster length to search for, 1 or more. Default 1
 - cutoff: The cutoff frequency, if an cluster occurs less times than this it is not returned. Default '5'
+- sort: ``freq`` to return the most frequent clusters first. Default is no particular order
+- limit: Only return this many of the most frequent clusters. Default is to return everything
 
 Parameters should be provided in querystring format, for example::
 
@@ -15,6 +17,11 @@ Parameters should be provided in querystring format, for example::
 
 Returns a ``data`` array, one entry per result. Each item is an array of ``[cluster, frequency]``.
 
+If ``limit`` was given, the footer will contain ``total``, the number of
+clusters above the cutoff, and ``total_with_ties``, the number of clusters at
+least as frequent as the last one returned. If this is more than ``limit``,
+other clusters were just as frequent as the last one but weren't returned.
+
 The ``version`` object gives both the current version of CLiC and the revision of the
 corpora ingested in the database.
 
@@ -88,7 +95,13 @@ The cluster search peforms the following steps:
      will cause a gap in the tokens.
 
 4. For the remaining clusters, count instances of each unique cluster, applying
-   frequency cut-off before returning result.
+   frequency cut-off before returning result. The number of clusters below the
+   cut-off is counted separately, so they aren't returned by the database.
+
+Steps 2--4 are done for each book & subset when it is imported, for clusters
+of up to 5 types, and stored in the ``book_ngram`` table. A search then only
+has to add together the counts for each book. Longer clusters are counted from
+integer arrays of each book's types, see `ngram <ngram.py>`__.
 
 Examples / edge cases
 ---------------------
@@ -207,21 +220,80 @@ We do not form clusters across books when selecting multiple books::
     ...   subset=['nonquote'], clusterlength=['2'], cutoff=['0'])) if 'alice' in x[0]]
     [('alice was', 1)]
 
+Clusters counted at import time are the same as those counted by ``clic.ngram``::
+
+    >>> import unittest.mock
+    >>> def all_clusters(**kwargs):
+    ...     return sorted(cluster(db_cur, corpora=['alice', 'willows'], **kwargs), key=repr)
+    >>> for s in ['all', 'quote', 'nonquote', 'shortsus', 'longsus']:
+    ...     for l in range(1, 6):
+    ...         for c in range(0, 3):
+    ...             stored = all_clusters(subset=[s], clusterlength=[str(l)], cutoff=[str(c)])
+    ...             with unittest.mock.patch('clic.cluster.MAX_STORED_CLUSTERLENGTH', 0):
+    ...                 scanned = all_clusters(subset=[s], clusterlength=[str(l)], cutoff=[str(c)])
+    ...             assert stored == scanned, (s, l, c)
+    ...             for order in (dict(limit=['3']), dict(sort=['freq'])):
+    ...                 stored = list(cluster(db_cur, corpora=['alice', 'willows'], subset=[s],
+    ...                     clusterlength=[str(l)], cutoff=[str(c)], **order))
+    ...                 with unittest.mock.patch('clic.cluster.MAX_STORED_CLUSTERLENGTH', 0):
+    ...                     scanned = list(cluster(db_cur, corpora=['alice', 'willows'], subset=[s],
+    ...                         clusterlength=[str(l)], cutoff=[str(c)], **order))
+    ...                 assert stored == scanned, (s, l, c, order)
+
+Clusters below the cutoff aren't returned, we just say how many there were::
+
+    >>> sorted(cluster(db_cur, corpora=['willows'], subset=['quote'], clusterlength=['2'], cutoff=['2']), key=repr)
+    [('been in', 2),
+     ('footer', {'info': {'message': '42 clusters with a frequency less than 2 are not shown'}}),
+     ('in a', 2), ('never been', 2)]
+
+We can ask for the most frequent clusters only. The footer says how many
+clusters there were in total, and how many were as frequent as the last one
+returned, so we know 3 other clusters were as frequent as "been in"::
+
+    >>> list(cluster(db_cur, corpora=['willows'], subset=['all'], clusterlength=['2'], cutoff=['2'], limit=['3']))
+    [('the mole', 3), ('the rat', 3), ('been in', 2),
+     ('footer', {'info': {'message': '166 clusters with a frequency less than 2 are not shown'},
+                 'total': 6, 'total_with_ties': 6})]
+
+...or all of them, most frequent first::
+
+    >>> list(cluster(db_cur, corpora=['willows'], subset=['quote'], clusterlength=['2'], cutoff=['2'], sort=['freq']))
+    [('been in', 2), ('in a', 2), ('never been', 2),
+     ('footer', {'info': {'message': '42 clusters with a frequency less than 2 are not shown'}})]
+
+Longer clusters are counted by ``clic.ngram``::
+
+    >>> [x for x in format_cluster(cluster(db_cur, corpora=['willows'],
+    ...   subset=['quote'], clusterlength=['6'], cutoff=['0'])) if x[0].startswith('what')]
+    [('what have you been doing then', 1)]
+
 """
 from clic.db.corpora import corpora_to_book_ids
+from clic.db.cursor import server_side_rows
 from clic.db.lookup import api_subset_lookup
+from clic.errors import UserError
+from clic.ngram import ngram_counts
+
+#: Longest cluster counted by book_import_finalise
+MAX_STORED_CLUSTERLENGTH = 5
 
 
 def cluster(
         cur,
         subset=['all'], corpora=['dickens'],
         clusterlength=['1'],
-        cutoff=None):
+        cutoff=None,
+        sort=[], limit=[]):
     # Defaults / dereference arrays
     book_ids = corpora_to_book_ids(cur, corpora)
     clusterlength = int(clusterlength[0])
     api_subset = api_subset_lookup(cur)
     rclass_ids = tuple(api_subset[s] for s in subset)
+    sort = sort[0] if sort else None
+    limit = int(limit[0]) if limit else None
+    if limit is not None and limit < 1:
+        raise UserError("Limit must be at least 1", "error")
 
     # Choose cutoff
     if cutoff is not None:
@@ -229,51 +301,93 @@ def cluster(
     else:
         cutoff = 5 if len(book_ids) > 1 else 2
 
-    skipped = 0
-    wl = get_word_list(cur, book_ids, rclass_ids, clusterlength)
-
+    wl, totals = get_word_list(cur, book_ids, rclass_ids, clusterlength, cutoff=cutoff, sort=sort, limit=limit)
     for term, freq in wl:
-        if freq >= cutoff:
-            yield (term, freq)
-        else:
-            skipped += 1
+        yield (term, freq)
 
-    if skipped > 0:
-        yield ('footer', dict(info=dict(
-            message='%d clusters with a frequency less than %d are not shown' % (skipped, cutoff)
-        )))
+    footer = {}
+    if totals['skipped'] > 0:
+        footer['info'] = dict(
+            message='%d clusters with a frequency less than %d are not shown' % (totals['skipped'], cutoff)
+        )
+    if limit is not None:
+        footer['total'] = totals['total']
+        footer['total_with_ties'] = totals['total_with_ties']
+    if footer:
+        yield ('footer', footer)
 
 
-def get_word_list(cur, book_ids, rclass_ids, clusterlength):
+def get_word_list(cur, book_ids, rclass_ids, clusterlength, cutoff=0, sort=None, limit=None):
     """
-    Yields tuples of:
-    - Concatenated tokens
-    - Frequency of them in given text
+    Returns a tuple of:
+    - An iterable of tuples of:
+      - Concatenated tokens
+      - Frequency of them in given text
+    - A dict of totals:
+      - skipped: The number of clusters not returned as their frequency is less than (cutoff)
+      - total: The number of clusters with a frequency of at least (cutoff), if (limit) given
+      - total_with_ties: The number of clusters at least as frequent as the
+        last one returned, i.e. including any that tie with it, if (limit) given
+
+    - sort: 'freq' to return the most frequent clusters first, ties in
+      codepoint order (i.e. the "C" collation, as Python sorts strings).
+      Default is no particular order
+    - limit: Only return this many clusters, implies sort='freq'
+
+    Clusters up to MAX_STORED_CLUSTERLENGTH are counted when a book is imported
+    (see ``book_ngram``), so we only need to add up the counts for each book.
+    The cutoff is applied in the database, and clusters below it counted in a
+    separate query, so they are never fetched. Longer clusters are counted from
+    the positional index, see ``clic.ngram``.
     """
     if len(rclass_ids) != 1:
         raise NotImplementedError()
+    if sort not in (None, 'freq'):
+        raise UserError('Unknown sort option "%s", should be freq' % sort, "error")
+
+    if clusterlength > MAX_STORED_CLUSTERLENGTH:
+        return ngram_counts(cur, book_ids, rclass_ids[0], clusterlength, cutoff=cutoff, sort=sort, limit=limit)
 
-    query = """
-        SELECT ttypes
-             , COUNT(*)
-          FROM (
-            SELECT book_id
-                 , CASE WHEN MAX(ordering) OVER ngram - MIN(ordering) OVER ngram = %(extra_tokens)s
-                         AND COUNT(ttype) OVER ngram = %(extra_tokens)s + 1
-                        THEN STRING_AGG(ttype, ' ')  OVER ngram
-                         END ttypes
-              FROM token t
-             WHERE book_id IN %(book_ids)s
-               AND t.part_of ? %(rclass_id)s
-            WINDOW ngram AS (PARTITION BY book_id ORDER BY ordering ROWS BETWEEN %(extra_tokens)s PRECEDING AND CURRENT ROW)
-               ) all_ngrams
-         WHERE ttypes IS NOT NULL
-      GROUP BY ttypes
-    """
     params = dict(
         book_ids=tuple(book_ids),
-        extra_tokens=clusterlength - 1,
-        rclass_id=str(rclass_ids[0]),
+        rclass_id=rclass_ids[0],
+        clusterlength=clusterlength,
+        cutoff=cutoff,
+        limit=limit,
     )
-    cur.execute(query, params)
-    return cur
+    query = """
+        SELECT bn.ngram
+             , SUM(bn.ngram_count)::INT ngram_count
+          FROM book_ngram bn
+         WHERE bn.book_id IN %(book_ids)s
+           AND bn.rclass_id = %(rclass_id)s
+           AND bn.ngram_length = %(clusterlength)s
+      GROUP BY bn.ngram
+    """
+    totals_query = """
+        SELECT COUNT(*) FILTER (WHERE c.ngram_count < %(cutoff)s)
+             , COUNT(*) FILTER (WHERE c.ngram_count >= %(cutoff)s)
+             , COUNT(*) FILTER (WHERE c.ngram_count >= %(last_count)s)
+          FROM (""" + query + """) c
+    """
+
+    if limit is None:
+        totals = dict(skipped=0)
+        if cutoff > 1:
+            cur.execute(totals_query, dict(params, last_count=cutoff))
+            totals['skipped'] = cur.fetchone()[0]
+        query += "HAVING SUM(bn.ngram_count) >= %(cutoff)s\n"
+        if sort == 'freq':
+            query += "ORDER BY ngram_count DESC, bn.ngram COLLATE \"C\"\n"
+        return server_side_rows(cur, query, params), totals
+
+    # Only fetch the top (limit) clusters, then count the rest
+    cur.execute(query + """
+        HAVING SUM(bn.ngram_count) >= %(cutoff)s
+      ORDER BY ngram_count DESC, bn.ngram COLLATE "C"
+         LIMIT %(limit)s
+    """, params)
+    rows = cur.fetchall()
+    cur.execute(totals_query, dict(params, last_count=max(rows[-1][1] if rows else 0, cutoff)))
+    skipped, total, total_with_ties = cur.fetchone()
+    return rows, dict(skipped=skipped, total=total, total_with_ties=total_with_ties)
@@ -0,0 +1,207 @@
+"""
+clic.collocation: Collocation endpoint
+**************************************
+
+Return a list of types that occur near a concordance search's nodes, i.e. its
+collocates, and how strongly they are associated with it.
+
+- corpora: 1+ corpus name (e.g. 'dickens') or book name ('AgnesG') to search within
+- subset: subset to search through, one of shortsus/longsus/nonquote/quote/all. Default 'all' (i.e. all text)
+- q: 1+ string to search for, as per concordance. Collocates of all are combined
+- windowleft: Number of tokens to the left of each node to consider. Default '5'
+- windowright: Number of tokens to the right of each node to consider. Default '5'
+- cutoff: The cutoff frequency, if a collocate occurs less times than this it is not returned. Default '5'
+
+Parameters should be provided in querystring format, for example::
+
+    ?corpora=dickens&subset=quote&q=dear&windowleft=3&windowright=3
+
+Returns a ``data`` array, one entry per collocate, strongest first. Each item
+is an array of ``[collocate, frequency, corpus frequency, MI, LL]``:
+
+- frequency: Number of times the collocate appears in a node's window
+- corpus frequency: Number of times the collocate appears anywhere in the subset
+- MI: Mutual information, ``log2(frequency / expected)``, where
+  ``expected = corpus frequency * nodes * (windowleft + windowright) / tokens in subset``
+- LL: Log-likelihood of the collocate occurring as often as it does within
+  windows, compared to the rest of the subset, see ``clic.keyword.log_likelihood``
+
+Method
+------
+
+1. Find the nodes for each query with the concordance query (steps 2--6 of
+   `concordance <concordance.py>`__).
+
+2. Join each node to the tokens within (windowleft) of its first token and
+   (windowright) of its last token, not including the node itself. Windows
+   don't extend outside the subset, so a window at the end of a quote will be
+   smaller. Tokens in overlapping windows are counted once for each window.
+
+3. Count the tokens of each type, and the total number of nodes. These, along
+   with the frequency of each type in the subset (from ``book_ttype``), are
+   fetched from the database in one statement.
+
+4. Work out MI & LL for each type, applying the cutoff.
+
+Examples / edge cases
+---------------------
+
+These are the corpora we use for the following tests::
+
+    >>> db_cur = test_database(
+    ... alice='''
+    ... ‘Well!’ thought Alice to herself, ‘after such a fall as this, I shall
+    ... think nothing of tumbling down stairs! How brave they’ll all think me at
+    ... home! Why, I wouldn’t say anything about it, even if I fell off the top
+    ... of the house!’ (Which was very likely true.)
+    ... ''',
+    ...
+    ... willows='''
+    ... ‘Get off!’ spluttered the Rat, with his mouth full.
+    ...
+    ... ‘Thought I should find you here all right,’ said the Otter cheerfully.
+    ... ‘They were all in a great state of alarm along River Bank when I arrived
+    ... this morning.
+    ... ''')
+
+Each collocate comes with frequency, corpus frequency, MI and LL. Both
+occurrences of "the" are within 2 tokens of "of", the other collocates are
+below the cutoff::
+
+    >>> for x in collocation(db_cur, corpora=['alice'], q=['of'],
+    ...                      windowleft=['2'], windowright=['2'], cutoff=['2']):
+    ...     print(x)
+    ['the', 2, 2, 2.61, 7.25]
+    ('footer', {'info': {'message': '6 collocates with a frequency less than 2 are not shown'}})
+
+Windows can be lopsided, and don't include the node itself::
+
+    >>> format_cluster(collocation(db_cur, corpora=['alice'], q=['i'],
+    ...                windowleft=['0'], windowright=['1'], cutoff=['0']))
+    [['fell', 1, 1, 4.03, 5.59], ['shall', 1, 1, 4.03, 5.59], ["wouldn't", 1, 1, 4.03, 5.59]]
+
+Multi-word queries work, and collocates of every query are combined::
+
+    >>> format_cluster(collocation(db_cur, corpora=['alice', 'willows'], q=['the rat', 'the otter'],
+    ...                windowleft=['1'], windowright=['1'], cutoff=['0']))
+    [['cheerfully', 1, 1, 4.44, 6.16], ['said', 1, 1, 4.44, 6.16],
+     ['spluttered', 1, 1, 4.44, 6.16], ['with', 1, 1, 4.44, 6.16]]
+
+Windows stay within the subset. "off" is in a quote, and the next non-quote
+text ("said the Otter") is too far away::
+
+    >>> format_cluster(collocation(db_cur, corpora=['willows'], subset=['nonquote'],
+    ...                q=['spluttered'], cutoff=['0']))
+    [['his', 1, 1, 1.49, 3.45], ['mouth', 1, 1, 1.49, 3.45], ['rat', 1, 1, 1.49, 3.45],
+     ['the', 1, 2, 0.49, 1.07], ['with', 1, 1, 1.49, 3.45]]
+
+If nothing matches, there are no collocates::
+
+    >>> list(collocation(db_cur, corpora=['alice'], q=['mouse']))
+    []
+"""
+import math
+
+import pandas as pd
+
+from clic.concordance import node_query, parse_query
+from clic.db.corpora import corpora_to_book_ids
+from clic.db.lookup import api_subset_lookup
+from clic.errors import UserError
+from clic.keyword import log_likelihood
+
+
+def collocation(
+        cur,
+        corpora=['dickens'], subset=['all'],
+        q=[],
+        windowleft=['5'], windowright=['5'],
+        cutoff=['5']):
+    # Defaults / dereference arrays
+    book_ids = tuple(corpora_to_book_ids(cur, corpora))
+    if len(book_ids) == 0:
+        raise UserError("No books to search", "error")
+    api_subset = api_subset_lookup(cur)
+    rclass_ids = tuple(api_subset[s] for s in subset)
+    if len(rclass_ids) != 1:
+        raise UserError("You must supply exactly one subset", "error")
+    like_sets = [parse_query(s) for s in q]
+    if len(like_sets) == 0:
+        raise UserError("You must supply at least one search term", "error")
+    windowleft = int(windowleft[0])
+    windowright = int(windowright[0])
+    if windowleft < 0 or windowright < 0 or windowleft + windowright == 0:
+        raise UserError("Window must include at least one token", "error")
+    cutoff = int(cutoff[0])
+
+    query, params, _ = node_query(cur, book_ids, rclass_ids[0], like_sets)
+    if not query:
+        return
+    params['windowleft'] = windowleft
+    params['windowright'] = windowright
+
+    cur.execute("""
+        WITH nodes AS (""" + query + """)
+           , collocates AS (
+             SELECT t.ttype
+                  , COUNT(*) window_count
+               FROM nodes m
+               JOIN token t
+                 ON t.book_id = m.book_id
+                AND t.ordering BETWEEN m.node_ordering - %(windowleft)s
+                                   AND m.node_ordering + m.total_likes - 1 + %(windowright)s
+                AND t.ordering NOT BETWEEN m.node_ordering
+                                       AND m.node_ordering + m.total_likes - 1
+              WHERE (t.part_of & rclass_bit(%(rclass_id)s)) <> 0
+           GROUP BY t.ttype
+        )
+        SELECT c.ttype
+             , c.window_count
+             , SUM(bt.ttype_count) corpus_count
+             , (SELECT COUNT(*) FROM nodes) node_count
+          FROM collocates c
+          JOIN lexicon l ON l.ttype = c.ttype
+          JOIN book_ttype bt ON bt.ttype_id = l.ttype_id
+         WHERE bt.book_id IN %(book_ids)s
+           AND bt.rclass_id = %(rclass_id)s
+      GROUP BY c.ttype, c.window_count
+    """, params)
+    counts = pd.DataFrame(cur.fetchall(), columns=('Type', 'Count_analysis', 'Corpus_count', 'Nodes'))
+    if len(counts) == 0:
+        return
+    counts = counts.astype(dict(Count_analysis=int, Corpus_count=int, Nodes=int))
+
+    cur.execute("""
+        SELECT COALESCE(SUM(bt.ttype_count), 0)
+          FROM book_ttype bt
+         WHERE bt.book_id IN %(book_ids)s
+           AND bt.rclass_id = %(rclass_id)s
+    """, params)
+    total_tokens = int(cur.fetchone()[0])
+    total_window = int(counts.Count_analysis.sum())
+
+    # Compare windows against the rest of the subset. Overlapping windows can
+    # count a token more than once, so don't let the remainder go negative
+    counts['Total_analysis'] = total_window
+    counts['Count_ref'] = (counts.Corpus_count - counts.Count_analysis).clip(lower=0)
+    counts['Total_ref'] = max(total_tokens - total_window, 0)
+    counts = log_likelihood(counts)
+
+    span = windowleft + windowright
+    counts['MI'] = [
+        math.log2(o / (c * n * span / total_tokens))
+        for o, c, n in zip(counts.Count_analysis, counts.Corpus_count, counts.Nodes)
+    ]
+
+    counts = counts.sort_values(['LL', 'Count_analysis', 'Type'], ascending=[False, False, True])
+    skipped = 0
+    for r in counts.itertuples():
+        if r.Count_analysis >= cutoff:
+            yield [r.Type, int(r.Count_analysis), int(r.Corpus_count), round(float(r.MI), 2), round(float(r.LL), 2)]
+        else:
+            skipped += 1
+
+    if skipped > 0:
+        yield ('footer', dict(info=dict(
+            message='%d collocates with a frequency less than %d are not shown' % (skipped, cutoff)
+        )))
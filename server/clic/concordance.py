@@ -9,12 +9,21 @@ Searches texts for given phrase(s).
 - q: 1+ string to search for. If multiple terms are provided, we will search for each in turn
 - contextsize: Size of context window around search results. Default 0.
 - metadata: Optional data to return, see `book_metadata.py <db/book_metadata.py>`__ for all options.
+- limit: Maximum number of results to return. Default is to return everything.
+- continuation: Continue a search from where a previous ``limit``-ed search stopped.
+- sort: Order results by one or more of ``book`` (default), ``node`` (the node's types),
+  ``L1``..``L5`` (the type 1..5 tokens left of the node) or ``R1``..``R5``.
+- sample: Return a random sample of up to this many results for each query.
+- seed: Seed for the random sample, the same seed will return the same sample. Default 0.
+- mode: ``conc`` (default) to return concordance lines, or ``count`` to return the number
+  of hits for each query.
 
 Parameters should be provided in querystring format, for example::
 
     ?corpora=dickens&corpora=AgnesG&q=my+hands&q=my+feet
 
-Returns a ``data`` array, one entry per result. Each item is an array with the following items:
+Returns a ``data`` array, one entry per result. The data array is sorted by query,
+then the ``sort`` option(s), then book id, then position in the book. Each item is an array with the following items:
 
 * The left context window (if ``contextsize`` > 0, otherwise omitted)
 * The node (i.e. the text searched for)
@@ -45,6 +54,19 @@ Result metadata and Position-in-book metadata are currently subject to change.
 The ``version`` object gives both the current version of CLiC and the revision of the
 corpora ingested in the database.
 
+If ``limit`` was given and there are more results available, the footer will
+contain a ``continuation`` token. Repeat the search with this as the
+``continuation`` parameter to get the next page of results. Sorted or sampled
+searches cannot be continued, only the first ``limit`` results are returned.
+
+The header will contain ``estimated_hits``, an upper bound on the number of results
+based on the frequency of each query's anchor type (see Method below). This is
+available before any results are found, and also returned as an ``X-Estimated-Hits``
+HTTP header.
+
+If ``mode`` is ``count``, the ``data`` array instead contains a ``[query, hits]`` pair
+for each query, no context is fetched. ``limit``, ``continuation`` and ``sort`` are ignored.
+
 Query (q parameter) format
 --------------------------
 
@@ -57,6 +79,9 @@ characters at this point. For example, ``oliver`` will find instances of
 "Oliver" and "olvier", but ``oliver*`` will find "Oliver's" in addition. The
 asterisk can be used anywhere within a type, not just at the end.
 
+Searches that match too many different types (e.g. ``a*``), or where
+every type is just a wildcard (e.g. ``*``) are not allowed.
+
 Examples
 --------
 
@@ -91,6 +116,9 @@ The concordance search peforms the following steps:
 
 2. Tokenise each provided query using the standard method in `tokenizer <../clic.tokenizer>`_,
    converting into a list of database `like expressions`_ for types.
+   Each like expression is then expanded into a list of matching types, using
+   the lexicon of all types built at import time (see `book_ttype <db/book_ttype.py>`__).
+   If any expression matches too many types, the search is rejected.
    Note that the CLiC UI generally only provides
    one query, unless you select "Any word", in which case it separates on
    whitespace and gives multiple queries. For example:
@@ -99,20 +127,46 @@ The concordance search peforms the following steps:
    * "latter pavement" (any word) results in 2 queries, ``['latter']`` and ``['pavement']``
 
 3. For each query, choose an "anchor" type. The aim here is to find the least
-   frequent term that will filter the results the fastest. See
-   :func:`find_anchor_offset` for details.
+   frequent term that will filter the results the fastest. The frequency of
+   each term within the selected books & subset is looked up from statistics
+   gathered when importing books, see `book_ttype <db/book_ttype.py>`__.
+   See :func:`find_anchor_offset` for details.
+
+4. Fetch the positions of all types that the anchor expanded to in the given
+   books, and within the given region, from the positional index built at
+   import time. For example if our query was ``oliver*``, this would fetch
+   the types ``oliver``, ``oliver's``, ``olivers``, etc.
+
+5. Do the same for every other type in the query, shifting positions by the
+   type's offset in the query, and intersect with the anchor positions. What
+   remains is the start of every node that matches the whole query.
+
+6. Check that any wildcard-only types (e.g. ``*``) are in a relevant region,
+   since these aren't looked up in the positional index. Steps 4--6 for each
+   query are combined with ``UNION ALL``, so all queries are searched for in
+   one statement, and the results are sorted by query.
+
+7. For each node, fetch the tokens in the node and context, if required.
+   The text of each token, and the text between tokens, is stored alongside
+   the token when importing, so we don't need the original book text.
+
+8. Combine the results into concordance lines, add the
+   chapter/paragraph/sentence statistics from the anchor, return result.
 
-4. Search the database for all types that match this anchor in the given books,
-   and within the given region. For example if our query was ``oliver*``, this
-   would match the types ``oliver``, ``oliver's``, ``olivers``, etc.
+If a ``continuation`` is given, it contains the query index, book_id and
+token ordering of the last result returned. Steps 4--6 then only consider
+nodes after this point, stopping once ``limit`` results have been found.
 
-5. For each match, fetch the rest of the node types and context, if required.
+If a ``sample`` is requested, nodes are ordered by a hash of their position and
+the seed, and only the first ``sample`` are used. If sorting, the types to sort
+on are looked up for each node, and only the first ``limit`` are used. Context
+is only fetched for the nodes that are returned.
 
-6. Check that any remaining types in the node also match the query and are in a
-   relevant region.
-
-7. Combine the results with the text from the original book, add the
-   chapter/paragraph/sentence statistics from the anchor, return result.
+The books are split between ``CONCORDANCE_WORKERS`` database connections
+(default 3, set to 1 to turn off), searched in parallel and the results merged. This isn't done when sorting or sampling, since all
+books have to be considered together. Either way, results are read from
+server-side cursors, ``CURSOR_ITERSIZE`` rows at a time, so results start
+streaming straight away and are never all held in memory.
 
 .. _like expressions: https://www.postgresql.org/docs/9.5/static/functions-matching.html#SECT2
 
@@ -163,6 +217,13 @@ Can use ``?`` to match precisely one character::
     >>> format_conc(concordance(db_cur, ['willows'], q=['the*']))
     [['willows', 23, 'the'], ['willows', 103, 'the'], ['willows', 126, 'They']]
 
+...but at least one of the types has to be more than just a wildcard::
+
+    >>> format_conc(concordance(db_cur, ['willows'], q=['* *']))
+    Traceback (most recent call last):
+      ...
+    clic.errors.UserError: Search terms must contain at least one word that isn't just a wildcard
+
 Search multiple books at the same time::
 
     >>> format_conc(concordance(db_cur, ['alice', 'willows'], q=['f*ll *']))
@@ -214,6 +275,22 @@ Results can be limited to regions. We can get quote concordances::
     [['alice', 9, 'Well', '**', 'thought', '**', 'Alice'],
      ['willows', 55, 'full', '**', 'Thought', '**', 'I']]
 
+Every type in the node has to be within the subset, "full" isn't within a quote::
+
+    >>> format_conc(concordance(db_cur, ['willows'], q=["full thought"]))
+    [['willows', 47, 'full', 'Thought']]
+    >>> format_conc(concordance(db_cur, ['willows'], q=["full thought"], subset=["quote"]))
+    []
+    >>> format_conc(concordance(db_cur, ['willows'], q=["* thought"], subset=["quote"]))
+    []
+
+Wildcards don't match anything beyond the start or end of a book::
+
+    >>> format_conc(concordance(db_cur, ['willows'], q=["* get"]))
+    []
+    >>> format_conc(concordance(db_cur, ['willows'], q=["morning *"]))
+    []
+
 When searching in subsets, we do *not* consider boundaries, searching for
 "think I" finds a match that straddles 2 quotes::
 
@@ -222,6 +299,113 @@ When searching in subsets, we do *not* consider boundaries, searching for
       '**', 'think', 'I', '**',
       'had', 'NOT', 'cried', 'the', 'Mouse']]
 
+Examples: paging
+----------------
+
+Results can be returned a page at a time. If there are more results, the
+footer contains a continuation token::
+
+    >>> out = list(concordance(db_cur, ['alice', 'willows'], q=['f*ll'], limit=[2]))
+    >>> format_conc(out)
+    [['alice', 49, 'fall'], ['alice', 199, 'fell']]
+    >>> out[-1]
+    ('footer', {'continuation': '0:1:38'})
+
+...which we use to get the next page. Pages continue onto the next book, and
+the next query::
+
+    >>> out = list(concordance(db_cur, ['alice', 'willows'], q=['f*ll', 'thought'], limit=[2], continuation=[out[-1][1]['continuation']]))
+    >>> format_conc(out)
+    [['alice', 9, 'thought'], ['willows', 47, 'full']]
+    >>> out = list(concordance(db_cur, ['alice', 'willows'], q=['f*ll', 'thought'], limit=[2], continuation=[out[-1][1]['continuation']]))
+    >>> format_conc(out)
+    [['willows', 55, 'Thought']]
+
+Once there are no more results, there is no continuation token::
+
+    >>> [x for x in out if isinstance(x, tuple) and x[0] == 'footer']
+    []
+
+Examples: sorting and sampling
+------------------------------
+
+Results can be sorted by the types around the node, for example the first type
+to the right::
+
+    >>> format_conc(concordance(db_cur, ['willows'], q=['the'], sort=['R1'], contextsize=[1]), sort=False)
+    [['willows', 103, 'said', '**', 'the', '**', 'Otter'],
+     ['willows', 23, 'spluttered', '**', 'the', '**', 'Rat']]
+
+...or the first type to the left. Multiple sort options can be given, later
+ones are used when earlier ones are equal::
+
+    >>> format_conc(concordance(db_cur, ['alice'], q=['the'], sort=['L1', 'R1'], contextsize=[1]), sort=False)
+    [['alice', 369, 'cried', '**', 'the', '**', 'Mouse'],
+     ['alice', 219, 'of', '**', 'the', '**', 'house'],
+     ['alice', 208, 'off', '**', 'the', '**', 'top'],
+     ['alice', 323, 'to', '**', 'the', '**', 'fifth']]
+
+Sorting by the node itself is useful when using wildcards::
+
+    >>> format_conc(concordance(db_cur, ['alice', 'willows'], q=['f*ll'], sort=['node']), sort=False)
+    [['alice', 49, 'fall'], ['alice', 199, 'fell'], ['willows', 47, 'full']]
+
+We can also ask for a random sample of results. The same seed gives the same
+results::
+
+    >>> out = format_conc(concordance(db_cur, ['alice', 'willows'], q=['the'], sample=[3]), sort=False)
+    >>> len(out)
+    3
+    >>> out == format_conc(concordance(db_cur, ['alice', 'willows'], q=['the'], sample=[3]), sort=False)
+    True
+    >>> out == format_conc(concordance(db_cur, ['alice', 'willows'], q=['the'], sample=[3], seed=['1']), sort=False)
+    False
+
+A sample has to contain something::
+
+    >>> out = list(concordance(db_cur, ['alice', 'willows'], q=['the'], sample=[0]))
+    Traceback (most recent call last):
+      ...
+    clic.errors.UserError: Sample must be at least 1
+
+Sorted or sampled searches can't be continued::
+
+    >>> out = list(concordance(db_cur, ['alice', 'willows'], q=['the'], sort=['R1'], limit=[2]))
+    >>> [x for x in out if isinstance(x, tuple) and x[0] == 'footer']
+    []
+    >>> out = list(concordance(db_cur, ['alice', 'willows'], q=['the'], sort=['R1'], continuation=['0:1:1']))
+    Traceback (most recent call last):
+      ...
+    clic.errors.UserError: Cannot continue a sorted or sampled search
+
+Examples: counting
+------------------
+
+We can just count the number of hits, which is cheaper than fetching them::
+
+    >>> list(concordance(db_cur, ['alice', 'willows'], q=['the', 'f*ll *', 'the mouse', 'rabbit'], mode=['count']))
+    [('ready', {'estimated_hits': 10}),
+     ['the', 6],
+     ['f*ll *', 3],
+     ['the mouse', 1],
+     ['rabbit', 0]]
+
+The ``estimated_hits`` in the header is based on type frequencies, so is
+available before searching. It's exact for single types, and an upper bound
+otherwise::
+
+    >>> list(concordance(db_cur, ['alice', 'willows'], q=['the alice'], mode=['count']))
+    [('ready', {'estimated_hits': 2}), ['the alice', 0]]
+
+Counting a sample gives the size of the sample for each query, the same as the
+estimate does::
+
+    >>> list(concordance(db_cur, ['alice', 'willows'], q=['the', 'f*ll *', 'rabbit'], mode=['count'], sample=[4]))
+    [('ready', {'estimated_hits': 7}),
+     ['the', 4],
+     ['f*ll *', 3],
+     ['rabbit', 0]]
+
 Query parsing
 -------------
 
@@ -262,19 +446,19 @@ import re
 
 from clic.db.book import get_book
 from clic.db.book_metadata import get_book_metadata
+from clic.db.book_ttype import ttype_expand
 from clic.db.corpora import corpora_to_book_ids
-from clic.db.lookup import api_subset_lookup, rclass_id_lookup
+from clic.db.cursor import merged_server_side_rows, pool_cursors, pool_workers, server_side_rows
+from clic.db.lookup import api_subset_lookup
 from clic.errors import UserError
-from clic.tokenizer import types_from_string
-
-RE_WHITESPACE = re.compile(r'(\s+)')  # Capture the whitespace so split returns it
+from clic.tokenizer import types_from_string, split_separator
 
-
-#: Most frequent words in entirety of corpora, as of 2018-12-13
+#: Most frequent words in entirety of corpora, as of 2018-12-13. Only used to
+#: choose an anchor when frequency statistics can't decide
 STOPWORDS = set(("the", "and", "to", "of", "a", "i", "in", "he", "was", "that"))
 
 
-def concordance(cur, corpora=['dickens'], subset=['all'], q=[], contextsize=['0'], metadata=[]):
+def concordance(cur, corpora=['dickens'], subset=['all'], q=[], contextsize=['0'], metadata=[], limit=[], continuation=[], sort=['book'], sample=[], seed=['0'], mode=['conc']):
     """
     Main entry function for concordance search
 
@@ -284,12 +468,17 @@ def concordance(cur, corpora=['dickens'], subset=['all'], q=[], contextsize=['0'
     - contextsize: Size of context window, defaults to none.
     - metadata, Array of extra metadata to provide with result, some of
       - 'book_titles' (return dict of book IDs to titles at end of result)
+    - limit: Maximum number of results to return, default unlimited
+    - continuation: Token from a previous search's footer, to resume after
+    - sort: Order results by one or more of 'book', 'node', 'L1'..'L5', 'R1'..'R5'
+    - sample: Return a random sample of this many results for each query
+    - seed: Seed for choosing the random sample
+    - mode: 'conc' to return concordance lines, 'count' to return the number of hits for each query
     """
     book_ids = tuple(corpora_to_book_ids(cur, corpora))
     if len(book_ids) == 0:
         raise UserError("No books to search", "error")
     api_subset = api_subset_lookup(cur)
-    rclass = rclass_id_lookup(cur)
     rclass_ids = tuple(api_subset[s] for s in subset)
     if len(rclass_ids) != 1:
         raise UserError("You must supply exactly one subset", "error")
@@ -298,83 +487,345 @@ def concordance(cur, corpora=['dickens'], subset=['all'], q=[], contextsize=['0'
         raise UserError("You must supply at least one search term", "error")
     contextsize = int(contextsize[0])
     metadata = set(metadata)
+    limit = int(limit[0]) if limit else None
+    if limit is not None and limit < 1:
+        raise UserError("Limit must be at least 1", "error")
+    after = parse_continuation(continuation, 3)
+    next_continuation = None
+    sample = int(sample[0]) if sample else None
+    if sample is not None and sample < 1:
+        raise UserError("Sample must be at least 1", "error")
+    seed = str(seed[0])
+    paged = sort == ['book'] and sample is None  # Continuations only work in book order
+    if after and not paged:
+        raise UserError("Cannot continue a sorted or sampled search", "error")
     book = None
 
-    book_cur = cur.connection.cursor()
-    try:
-        for likes in like_sets:
-            # Choose an "anchor". We search for this first to narrow the possible
-            # outputs as much as possible, then consider the types around each.
-            anchor_offset = find_anchor_offset(*likes)
-
-            query = ""
-            params = dict()
-            query += """
-                 SELECT t.book_id
-                      , c.node_start - 1 node_start -- NB: Postgres is 1-indexed
-                      , c.cranges full_tokens
-                      , t.part_of
-                   FROM token t
-                   JOIN LATERAL ( -- i.e. for each valid anchor token, get all tokens around it, including context
-                       SELECT ARRAY_POSITION(ARRAY_AGG(t_surrounding.ordering = t.ordering ORDER BY book_id, ordering), TRUE) - %(anchor_offset)s node_start
-                            , ARRAY_AGG(CASE WHEN t_surrounding.ordering < (t.ordering - %(anchor_offset)s) THEN t_surrounding.ttype -- i.e. part of the context, so rclass irrelevant
-                                             WHEN t_surrounding.ordering > (t.ordering - %(anchor_offset)s + %(total_likes)s - 1) THEN t_surrounding.ttype -- i.e. part of the context, so rclass irrelevant
-                                             WHEN t_surrounding.part_of ? %(part_of)s THEN t_surrounding.ttype
-                                             ELSE NULL -- part of the node, but not in the right rclass, NULL should fail any node checks later on
-                                              END ORDER BY book_id, ordering) ttypes
-                            , ARRAY_AGG(t_surrounding.crange ORDER BY book_id, ordering) cranges
-                         FROM token t_surrounding
-                        WHERE t_surrounding.book_id = t.book_id
-                          AND t_surrounding.ordering BETWEEN t.ordering - %(anchor_offset)s - %(contextsize)s
-                                             AND t.ordering - %(anchor_offset)s + (%(total_likes)s - 1) + %(contextsize)s
-                   ) c on TRUE
-                 WHERE t.book_id IN %(book_ids)s
-                   AND t.part_of ? %(part_of)s
-            """
-            params['anchor_offset'] = anchor_offset
-            params['anchor_like'] = likes[anchor_offset]
-            params['book_ids'] = book_ids
-            params['contextsize'] = contextsize
-            params['total_likes'] = len(likes)
-            params['part_of'] = str(rclass_ids[0])
-
-            for i, l in enumerate(likes):
-                if i == anchor_offset:
-                    # We should check the main token table for the anchor node, so
-                    # postgres searches for this first
-                    query += "AND t.ttype LIKE %(like_" + str(i) + ")s\n"
-                else:
-                    query += "AND c.ttypes[c.node_start + " + str(i) + "] LIKE %(like_" + str(i) + ")s\n"
-                params["like_" + str(i)] = l
-
-            cur.execute(query, params)
-            for book_id, node_start, full_tokens, part_of in cur:
-                # Extract portion of tokens that are the node
-                node_tokens = full_tokens[node_start:node_start + len(likes)]
+    if mode[0] not in ('conc', 'count'):
+        raise UserError('Unknown mode "%s"' % mode[0], "error")
+    if mode[0] == 'count':
+        after = None  # Always count everything
+
+    sort_exprs = [sort_expression(s) for s in sort]
+
+    query, params, anchor_freqs = node_query(cur, book_ids, rclass_ids[0], like_sets, after=after)
+    yield ('ready', dict(estimated_hits=sum(
+        f if sample is None else min(sample, f) for f in anchor_freqs
+    )))
+    params['contextsize'] = contextsize
+    params['seed'] = seed
+
+    if mode[0] == 'count':
+        counts = {}
+        if query:
+            cur.execute("""
+                 SELECT m.q_index, COUNT(*)
+                   FROM (""" + query + """) m
+               GROUP BY m.q_index
+            """, params)
+            counts = dict(cur.fetchall())
+        for q_index, query_string in enumerate(q):
+            count = counts.get(q_index, 0)
+            yield [query_string, count if sample is None else min(sample, count)]
+    if mode[0] == 'count' or not query:
+        footer = get_book_metadata(cur, book_ids, metadata)
+        if footer:
+            yield ('footer', footer)
+        return
+
+    if sample is not None:
+        # Choose a pseudo-random sample of each query's nodes, repeatable for a given seed
+        query = """
+             SELECT m.*
+               FROM (
+                 SELECT m.*
+                      , ROW_NUMBER() OVER (
+                            PARTITION BY m.q_index
+                                ORDER BY MD5(%(seed)s || ':' || m.book_id || ':' || m.node_ordering)
+                        ) sample_rank
+                   FROM (""" + query + """) m
+               ) m
+              WHERE m.sample_rank <= %(sample)s
+        """
+        params['sample'] = sample
+
+    # Sort nodes, only fetching the types we sort on, then select the page we need
+    query = """
+         SELECT m.q_index
+              , m.total_likes
+              , m.anchor_offset
+              , m.book_id
+              , m.node_ordering
+    """ + "".join("""
+              , """ + sort_expr + """ sort_""" + str(i) + """
+    """ for i, sort_expr in enumerate(sort_exprs)) + """
+           FROM (""" + query + """) m
+       ORDER BY m.q_index, """ + "".join("sort_" + str(i) + ", " for i in range(len(sort_exprs))) + """m.book_id, m.node_ordering
+    """
+    if limit is not None:
+        # Fetch one more than we need, so we know if there's another page
+        query += "LIMIT %(limit)s\n"
+        params['limit'] = limit + 1
+
+    # For each node we return, get all tokens around it, including context
+    query = """
+         SELECT n.q_index
+              , n.book_id
+              , n.node_ordering
+              , c.node_start - 1 node_start -- NB: Postgres is 1-indexed
+              , c.ttexts
+              , c.separators
+              , c.node_lower
+              , c.node_upper
+              , c.chapter
+              , c.paragraph
+              , c.sentence
+           FROM (""" + query + """) n
+           JOIN LATERAL (
+               SELECT ARRAY_POSITION(ARRAY_AGG(t_surrounding.ordering = n.node_ordering ORDER BY book_id, ordering), TRUE) node_start
+                    , ARRAY_AGG(t_surrounding.ttext ORDER BY book_id, ordering) ttexts
+                    , ARRAY_AGG(t_surrounding.separator ORDER BY book_id, ordering) separators
+                    , MIN(LOWER(t_surrounding.crange)) FILTER (WHERE t_surrounding.ordering >= n.node_ordering) node_lower
+                    , MAX(UPPER(t_surrounding.crange)) FILTER (WHERE t_surrounding.ordering < n.node_ordering + n.total_likes) node_upper
+                    , MAX(t_surrounding.chapter) FILTER (WHERE t_surrounding.ordering = n.node_ordering + n.anchor_offset) chapter
+                    , MAX(t_surrounding.paragraph) FILTER (WHERE t_surrounding.ordering = n.node_ordering + n.anchor_offset) paragraph
+                    , MAX(t_surrounding.sentence) FILTER (WHERE t_surrounding.ordering = n.node_ordering + n.anchor_offset) sentence
+                 FROM token t_surrounding
+                WHERE t_surrounding.book_id = n.book_id
+                  AND t_surrounding.ordering BETWEEN n.node_ordering - %(contextsize)s
+                                     AND n.node_ordering + (n.total_likes - 1) + %(contextsize)s
+           ) c on TRUE
+       ORDER BY n.q_index, """ + "".join("n.sort_" + str(i) + ", " for i in range(len(sort_exprs))) + """n.book_id, n.node_ordering
+    """
+
+    # Split books between connections, each book's tokens are in their own
+    # partition so can be searched independently. Results then need merging
+    # back into order, which we can only do in book order.
+    workers = pool_workers('CONCORDANCE_WORKERS') if paged else 1
+
+    with pool_cursors(cur, min(workers, len(book_ids))) as curs:
+        if len(curs) > 1:
+            rows = merged_server_side_rows(curs, query, [
+                dict(params, book_ids=book_ids[i::len(curs)]) for i in range(len(curs))
+            ], key=lambda row: row[0:3])  # i.e. q_index, book_id, node_ordering
+        else:
+            # Stream rows from the database as we need them
+            rows = server_side_rows(cur, query, params)
+        book_cur = cur.connection.cursor()
+        try:
+            for q_index, book_id, node_ordering, node_start, ttexts, separators, node_lower, node_upper, chapter, paragraph, sentence in rows:
+                if limit is not None:
+                    if limit == 0:
+                        # There's at least one more result, stop here
+                        if paged:
+                            next_continuation = ':'.join(str(x) for x in after)
+                        break
+                    limit -= 1
+                after = (q_index, book_id, node_ordering)
                 if not book or book['id'] != book_id:
-                    book = get_book(book_cur, book_id, content=True)
-                yield to_conc(book['content'], full_tokens, node_tokens, contextsize) + [
-                    [book['name'], node_tokens[0].lower, node_tokens[-1].upper],
-                    [
-                        int(part_of.get(str(rclass['chapter.text']), -1)),
-                        int(part_of.get(str(rclass['chapter.paragraph']), -1)),
-                        int(part_of.get(str(rclass['chapter.sentence']), -1)),
-                    ]
+                    book = get_book(book_cur, book_id)
+                yield tokens_to_conc(ttexts, separators, node_start, node_start + len(like_sets[q_index]), contextsize) + [
+                    [book['name'], node_lower, node_upper],
+                    [-1 if x is None else x for x in (chapter, paragraph, sentence)],
                 ]
-    finally:
-        book_cur.close()
+        finally:
+            book_cur.close()
+            rows.close()  # NB: Close server-side cursors before the connections go back
 
     footer = get_book_metadata(cur, book_ids, metadata)
+    if next_continuation:
+        footer['continuation'] = next_continuation
     if footer:
         yield ('footer', footer)
 
 
-def find_anchor_offset(*types):
+def node_query(cur, book_ids, rclass_id, like_sets, after=None):
+    """
+    Build a query to find all nodes matching any of (like_sets), see steps 2--6 above
+
+    - book_ids: Book IDs to search within
+    - rclass_id: Region class to search within, e.g. from ``api_subset_lookup()``
+    - like_sets: List of queries, each a list of LIKE expressions from :func:`parse_query`
+    - after: Optional (q_index, book_id, node_ordering) tuple, only find nodes after this
+
+    Returns a tuple of:
+
+    - query: SQL returning q_index (index into like_sets), total_likes (length of node),
+      anchor_offset, book_id & node_ordering (ordering of the node's first token) for each node.
+      None if no nodes can match
+    - params: Parameters for query
+    - anchor_freqs: For each of (like_sets), frequency of the anchor, i.e. the
+      maximum number of nodes that can be found
+    """
+    # Choose an "anchor" for each query. We search for this first to narrow the
+    # possible outputs as much as possible, then consider the types around each.
+    anchor_offsets = []
+    anchor_freqs = []
+    expansion_sets = []
+    for likes in like_sets:
+        expansions = ttype_expand(cur, book_ids, rclass_id, likes)
+        if all(e is None for e in expansions):
+            raise UserError("Search terms must contain at least one word that isn't just a wildcard", "error")
+        freqs = [None if e is None else sum(e.values()) for e in expansions]
+        anchor_offsets.append(find_anchor_offset(*likes, freqs=freqs))
+        anchor_freqs.append(freqs[anchor_offsets[-1]])
+        expansion_sets.append(expansions)
+
+    params = dict(
+        book_ids=book_ids,
+        rclass_id=rclass_id,
+    )
+    if after:
+        params['after_book_id'], params['after_ordering'] = after[1:]
+
+    # Build a subquery for each query, all searched for in the same statement
+    subqueries = []
+    for q_index, likes in enumerate(like_sets):
+        if after and q_index < after[0]:
+            continue  # Already returned all of this query's results
+        expansions = expansion_sets[q_index]
+        anchor_offset = anchor_offsets[q_index]
+        if any(e == {} for e in expansions):
+            continue  # At least one term doesn't occur at all, so no results
+        continuing = after and q_index == after[0]
+        for i, e in enumerate(expansions):
+            if e is not None:
+                params["ttype_ids_%d_%d" % (q_index, i)] = list(e.keys())
+
+        # Intersect positions of the anchor with all other types, shifted so
+        # they all point at the start of the node
+        query = """
+             SELECT """ + str(q_index) + """ q_index
+                  , """ + str(len(likes)) + """ total_likes
+                  , """ + str(anchor_offset) + """ anchor_offset
+                  , m.book_id
+                  , m.node_ordering
+               FROM (
+        """
+        query += "INTERSECT".join("""
+                 SELECT bt.book_id
+                      , UNNEST(bt.orderings) - """ + str(i) + """ node_ordering
+                   FROM book_ttype bt
+                  WHERE bt.book_id IN %(book_ids)s
+                    AND bt.rclass_id = %(rclass_id)s
+                    AND bt.ttype_id = ANY(%(ttype_ids_""" + str(q_index) + "_" + str(i) + """)s)
+        """ + ("""
+                    AND bt.book_id >= %(after_book_id)s
+        """ if continuing else "") for i in [anchor_offset] + [
+            i for i, e in enumerate(expansions) if i != anchor_offset and e is not None
+        ])
+        query += """
+               ) m
+              WHERE TRUE
+        """
+        if continuing:
+            query += "AND (m.book_id, m.node_ordering) > (%(after_book_id)s, %(after_ordering)s)\n"
+        for i, e in enumerate(expansions):
+            if e is None:
+                # Types matching anything aren't worth looking up, check there
+                # is a token in the right rclass instead
+                query += """
+                    AND EXISTS (
+                        SELECT 1
+                          FROM token t
+                         WHERE t.book_id = m.book_id
+                           AND t.ordering = m.node_ordering + """ + str(i) + """
+                           AND (t.part_of & rclass_bit(%(rclass_id)s)) <> 0)
+                """
+        subqueries.append(query)
+
+    return ("UNION ALL".join(subqueries) if subqueries else None), params, anchor_freqs
+
+
+def sort_expression(sort):
+    """
+    Return an SQL expression for sorting a node ``m`` by (sort), one of:
+
+    - 'book': Position in the corpora, i.e. book then position within book
+    - 'node': The types within the node
+    - 'L1'..'L5': The type (n) tokens to the left of the node
+    - 'R1'..'R5': The type (n) tokens to the right of the node
+
+    ``m`` should have book_id, node_ordering, and total_likes (i.e. the number of types in the node).
+
+        >>> sort_expression('book')
+        'm.book_id'
+        >>> sort_expression('R4')
+        '(SELECT t.ttype FROM token t WHERE t.book_id = m.book_id AND t.ordering = m.node_ordering + m.total_likes - 1 + 4)'
+        >>> sort_expression('L6')
+        Traceback (most recent call last):
+          ...
+        clic.errors.UserError: Unknown sort option "L6", should be one of book, node, L1..L5, R1..R5
+    """
+    if sort == 'book':
+        return 'm.book_id'
+    if sort == 'node':
+        return (
+            "(SELECT ARRAY_AGG(t.ttype ORDER BY t.ordering) FROM token t"
+            " WHERE t.book_id = m.book_id AND t.ordering BETWEEN m.node_ordering AND m.node_ordering + m.total_likes - 1)"
+        )
+    m = re.fullmatch(r'([LR])([1-5])', sort)
+    if not m:
+        raise UserError('Unknown sort option "%s", should be one of book, node, L1..L5, R1..R5' % sort, "error")
+    return (
+        "(SELECT t.ttype FROM token t"
+        " WHERE t.book_id = m.book_id AND t.ordering = m.node_ordering " +
+        ("- %d)" if m.group(1) == 'L' else "+ m.total_likes - 1 + %d)")
+    ) % int(m.group(2))
+
+
+def parse_continuation(continuation, length):
+    """
+    Parse a continuation token from a previous search into a tuple of (length) ints,
+    or None if there isn't one
+
+        >>> parse_continuation(['0:3:1024'], 3)
+        (0, 3, 1024)
+        >>> parse_continuation([], 3) is None
+        True
+        >>> parse_continuation(['0:3'], 3)
+        Traceback (most recent call last):
+          ...
+        clic.errors.UserError: Invalid continuation token "0:3"
+    """
+    if not continuation:
+        return None
+    try:
+        out = tuple(int(x) for x in continuation[0].split(':'))
+    except ValueError:
+        out = ()
+    if len(out) != length:
+        raise UserError('Invalid continuation token "%s"' % continuation[0], "error")
+    return out
+
+
+def find_anchor_offset(*types, freqs=None):
     """
     Choose our anchor node in types and return the offset of the anchor node
     (i.e. 0 for the first word, 1 for the second...)
 
-    In general longest word is chosen::
+    - types: LIKE expressions for each type in the query
+    - freqs: Optional list of the number of tokens matching each of (types),
+      e.g. from :func:`~clic.db.book_ttype.ttype_frequencies`. None means "unknown"
+
+    If frequencies are available, the least frequent type is chosen::
+
+        >>> find_anchor_offset('said', 'the%', freqs=[10, 5000])
+        0
+
+        >>> find_anchor_offset('h%ds', 'upon', freqs=[800, 30])
+        1
+
+    Types without a frequency are never chosen over ones with::
+
+        >>> find_anchor_offset('%', 'fog', freqs=[None, 5000])
+        1
+
+    If frequencies are equal, or not available, we fall back to guessing
+    based on the types themselves. In general longest word is chosen::
+
+        >>> find_anchor_offset('our', 'reckoning', freqs=[0, 0])
+        1
 
         >>> find_anchor_offset('our', 'reckoning')
         1
@@ -406,7 +857,13 @@ def find_anchor_offset(*types):
     def type_score(t):
         return (0 if t in STOPWORDS else 100) + len(t) - t.count('%') - t.count('_')
 
-    return max(enumerate(types), key=lambda l: type_score(l[1]))[0]
+    if freqs is None:
+        freqs = [None] * len(types)
+
+    return min(range(len(types)), key=lambda i: (
+        float('inf') if freqs[i] is None else freqs[i],
+        -type_score(types[i]),
+    ))
 
 
 def to_conc(full_text, full_tokens, node_tokens, contextsize):
@@ -417,7 +874,35 @@ def to_conc(full_text, full_tokens, node_tokens, contextsize):
     - node_tokens: List of tokens, excluding window
     - contextsize: Number of tokens should be in window, if 0 then don't return window
 
-    A token is a NumericRange type indicating the range in full_text it corresponds to
+    A token is a NumericRange type indicating the range in full_text it corresponds to.
+    The database stores the text of tokens already split up, so this is only
+    needed when we have the full text, see :func:`tokens_to_conc`.
+    """
+    if len(node_tokens) == 0:
+        raise NotImplementedError("We don't support empty nodes")
+    node_start = full_tokens.index(node_tokens[0])
+    return tokens_to_conc(
+        [full_text[t.lower:t.upper] for t in full_tokens],
+        [split_separator(full_text[t.upper:t_next.lower]) for t, t_next in zip(full_tokens, full_tokens[1:])],
+        node_start,
+        node_start + len(node_tokens),
+        contextsize,
+    )
+
+
+def tokens_to_conc(ttexts, separators, node_start, node_end, contextsize):
+    """
+    Convert token text & separators back into wire format
+    - ttexts: Text of each token, including window
+    - separators: Text after each token, split at first whitespace (see :func:`~clic.tokenizer.split_separator`)
+    - node_start: Index of the first token in the node
+    - node_end: Index after the last token in the node
+    - contextsize: Number of tokens should be in window, if 0 then don't return window
+
+    For example::
+
+        >>> tokens_to_conc(['a', 'man', 'walked'], [('', ' ', ''), ('', ' ', ''), ('.', '', '')], 1, 2, 1)
+        [['a', ' ', [0]], ['man', [0]], [' ', 'walked', [1]]]
     """
     concs = [[]]
     toks = [[]]
@@ -426,37 +911,30 @@ def to_conc(full_text, full_tokens, node_tokens, contextsize):
         if s:
             l.append(s)
 
-    if len(node_tokens) == 0:
+    if node_end <= node_start:
         raise NotImplementedError("We don't support empty nodes")
-    prev_t = None
-    for t in full_tokens:
-        # Non-word characters before this word
-        intra_word = full_text[prev_t.upper:t.lower] if prev_t else ''
-        if t == node_tokens[0]:
+    for i, ttext in enumerate(ttexts):
+        if i == node_start:
             # First token of node
             concs.append([])
             toks.append([])
-            intra_word = re.split(RE_WHITESPACE, intra_word, maxsplit=1)
-            append_if_nonempty(concs[-2], intra_word[0])
-            if len(intra_word) > 1:
-                append_if_nonempty(concs[-2], intra_word[1])  # NB: Window gets space, not node
-                append_if_nonempty(concs[-1], intra_word[2])
-        elif prev_t == node_tokens[-1]:
+            if i > 0:
+                append_if_nonempty(concs[-2], separators[i - 1][0])
+                append_if_nonempty(concs[-2], separators[i - 1][1])  # NB: Window gets space, not node
+                append_if_nonempty(concs[-1], separators[i - 1][2])
+        elif i == node_end:
             # First token of right-window
             concs.append([])
             toks.append([])
-            intra_word = re.split(RE_WHITESPACE, intra_word, maxsplit=1)
-            append_if_nonempty(concs[-2], intra_word[0])
-            if len(intra_word) > 1:
-                append_if_nonempty(concs[-1], intra_word[1])  # NB: Window gets space, not node
-                append_if_nonempty(concs[-1], intra_word[2])
-        else:
+            append_if_nonempty(concs[-2], separators[i - 1][0])
+            append_if_nonempty(concs[-1], separators[i - 1][1])  # NB: Window gets space, not node
+            append_if_nonempty(concs[-1], separators[i - 1][2])
+        elif i > 0:
             # Add non-word characters before current tokens
-            append_if_nonempty(concs[-1], intra_word)
+            append_if_nonempty(concs[-1], ''.join(separators[i - 1]))
         # Add word token
         toks[-1].append(len(concs[-1]))
-        concs[-1].append(full_text[t.lower:t.upper])
-        prev_t = t
+        concs[-1].append(ttext)
 
     # Add array of indicies that are tokens to the end
     for i, c in enumerate(concs):
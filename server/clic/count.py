@@ -7,6 +7,7 @@ Returns counts of words within subsets
 - corpora: 1+ corpus name (e.g. 'dickens') or book name ('AgnesG') to search within
 - subset: Subset(s) to return counts for, one of shortsus/longsus/nonquote/quote/all.
 - metadata: Optional data to return, see `book_metadata.py <db/book_metadata.py>`__ for all options.
+- granularity: ``book`` (default) to return counts for each book, or ``chapter`` for each chapter.
 
 Parameters should be provided in querystring format, for example::
 
@@ -14,7 +15,8 @@ Parameters should be provided in querystring format, for example::
 
 Returns a ``data`` array, one entry per book. The first item is the book ID in question,
 the remaining items are the counts in the subsets, the order matching the subset querystring
-parameter.
+parameter. With ``granularity=chapter`` there is one entry per chapter, and the
+second item is the chapter number.
 
 Examples:
 
@@ -32,7 +34,12 @@ Word count peforms the following steps:
 1. Resolve the corpora option to a list of book IDs, translate the subset
    selection to a database region.
 
-2. For each book, count the tokens that appear in each of the selected regions.
+2. For each book, add up the word counts of each of the selected regions,
+   stored in ``book_word_count`` when the book was imported.
+
+3. For ``granularity=chapter``, ``book_word_count`` only has word counts for
+   whole chapters. For any other subset, count the tokens within each chapter
+   that appear in the selected regions.
 
 Examples / edge cases
 ---------------------
@@ -59,6 +66,19 @@ These are the corpora we use for the following tests::
     ... ‘Thought I should find you here all right,’ said the Otter cheerfully.
     ... ‘They were all in a great state of alarm along River Bank when I arrived
     ... this morning.
+    ... '''.strip(),
+    ...
+    ... pool='''
+    ... Alice’s Adventures in Wonderland
+    ... Lewis Carroll
+    ...
+    ... CHAPTER I. Down the Rabbit-Hole
+    ...
+    ... ‘Well!’ thought Alice to herself.
+    ...
+    ... CHAPTER II. The Pool of Tears
+    ...
+    ... ‘I had NOT!’ cried the Mouse, sharply and very angrily.
     ... '''.strip())
 
 Get word counts::
@@ -70,13 +90,28 @@ Get word counts / word counts both overall and in quotes::
 
     >>> sorted(list(count(db_cur, ['alice', 'willows'], ['all', 'quote'])))
     [('alice', 49, 40), ('willows', 38, 10)]
+
+Get word counts for each chapter::
+
+    >>> list(count(db_cur, ['alice', 'pool'], ['all', 'quote', 'nonquote'], granularity=['chapter']))
+    [('alice', 0, 49, 40, 9), ('pool', 1, 5, 1, 4), ('pool', 2, 10, 3, 7)]
+    >>> list(count(db_cur, ['pool'], ['all', 'quote', 'nonquote']))
+    [('pool', 15, 4, 11)]
+
+Other granularities aren't supported::
+
+    >>> list(count(db_cur, ['pool'], ['all'], granularity=['paragraph']))
+    Traceback (most recent call last):
+      ...
+    clic.errors.UserError: Unknown granularity "paragraph", should be book or chapter
 """
 from clic.db.book_metadata import get_book_metadata
 from clic.db.corpora import corpora_to_book_ids
-from clic.db.lookup import api_subset_lookup
+from clic.db.lookup import api_subset_lookup, rclass_id_lookup
+from clic.errors import UserError
 
 
-def count(cur, corpora=['dickens'], subset=['all', 'shortsus', 'longsus', 'nonquote', 'quote'], metadata=[]):
+def count(cur, corpora=['dickens'], subset=['all', 'shortsus', 'longsus', 'nonquote', 'quote'], metadata=[], granularity=['book']):
     """
     Get word counts for coprora
 
@@ -84,28 +119,104 @@ def count(cur, corpora=['dickens'], subset=['all', 'shortsus', 'longsus', 'nonqu
     - subset: Subset(s) to return counts for
     - metadata, Array of extra metadata to provide with result, some of
       - 'book_titles' (return dict of book IDs to titles at end of result)
+    - granularity: 'book' (default) for a count per book, 'chapter' for a count per chapter
     """
     book_ids = tuple(corpora_to_book_ids(cur, corpora))
+    if len(book_ids) == 0:
+        raise UserError("No books to search", "error")
     api_subset = api_subset_lookup(cur)
+    rclass = rclass_id_lookup(cur)
     rclass_ids = tuple(api_subset[s] for s in subset)
+
+    if granularity[0] == 'book':
+        rows = count_book(cur, book_ids, rclass_ids)
+    elif granularity[0] == 'chapter':
+        rows = count_chapter(cur, book_ids, rclass_ids, rclass['chapter.text'])
+    else:
+        raise UserError('Unknown granularity "%s", should be book or chapter' % granularity[0], "error")
+    for row in rows:
+        yield row
+
+    footer = get_book_metadata(cur, book_ids, set(metadata))
+    if footer:
+        yield ('footer', footer)
+
+
+def count_book(cur, book_ids, rclass_ids):
+    """
+    Return a list of (book name, count in each of rclass_ids...) for each book
+    """
     query = """
-        SELECT (SELECT name FROM book WHERE book_id = t.book_id) AS "name"
+        SELECT b.name
     """
-    params = dict(book_ids=book_ids)
+    params = dict(book_ids=book_ids, rclass_ids=rclass_ids)
     for r in rclass_ids:
         query += """
-             , COUNT(CASE WHEN t.part_of ? '%d' THEN 1 END) is_%d
+             , COALESCE(SUM(bwc.word_count) FILTER (WHERE bwc.rclass_id = %d), 0) is_%d
         """ % (r, r)
     query += """
-          FROM token t
-         WHERE t.book_id IN %(book_ids)s
-      GROUP BY book_id
+          FROM book b
+     LEFT JOIN book_word_count bwc
+            ON bwc.book_id = b.book_id
+           AND bwc.rclass_id IN %(rclass_ids)s
+         WHERE b.book_id IN %(book_ids)s
+      GROUP BY b.book_id, b.name
+      ORDER BY b.name
     """
     cur.execute(query, params)
+    return cur.fetchall()
 
-    for row in cur:
-        yield row
 
-    footer = get_book_metadata(cur, book_ids, set(metadata))
-    if footer:
-        yield ('footer', footer)
+def count_chapter(cur, book_ids, rclass_ids, chapter_rclass_id):
+    """
+    Yield (book name, chapter number, count in each of rclass_ids...) for each
+    chapter of each book
+
+    Only whole-chapter counts are in book_word_count, so for any other
+    subsets we fall back to counting the tokens in each chapter.
+    """
+    cur.execute("""
+        SELECT b.book_id
+             , b.name
+             , bwc.rvalue
+             , bwc.word_count
+          FROM book b
+          JOIN book_word_count bwc
+            ON bwc.book_id = b.book_id
+           AND bwc.rclass_id = %(chapter_rclass_id)s
+         WHERE b.book_id IN %(book_ids)s
+      ORDER BY b.name, bwc.rvalue
+    """, dict(
+        book_ids=book_ids,
+        chapter_rclass_id=chapter_rclass_id,
+    ))
+    chapters = cur.fetchall()
+
+    scan_rclass_ids = [r for r in rclass_ids if r != chapter_rclass_id]
+    scanned = {}
+    if scan_rclass_ids:
+        query = """
+            SELECT t.book_id
+                 , t.chapter chapter_num
+        """
+        params = dict(book_ids=book_ids, chapter_rclass_id=chapter_rclass_id)
+        for r in scan_rclass_ids:
+            query += """
+                 , COUNT(CASE WHEN (t.part_of & rclass_bit(%d)) <> 0 THEN 1 END) is_%d
+            """ % (r, r)
+        query += """
+              FROM token t
+             WHERE t.book_id IN %(book_ids)s
+               AND (t.part_of & rclass_bit(%(chapter_rclass_id)s)) <> 0
+          GROUP BY 1, 2
+        """
+        cur.execute(query, params)
+        for row in cur:
+            scanned[row[0:2]] = dict(zip(scan_rclass_ids, row[2:]))
+
+    for book_id, name, chapter_num, word_count in chapters:
+        counts = scanned.get((book_id, chapter_num), {})
+        yield (name, chapter_num) + tuple(
+            word_count if r == chapter_rclass_id else counts.get(r, 0)
+            for r in rclass_ids
+        )
@@ -5,8 +5,9 @@ clic.db.book: Fetch/store book dicts to DB
 import psycopg2
 import psycopg2.extras
 
+from clic.cache import cache_file
 from clic.db.lookup import rclass_id_lookup
-from clic.tokenizer import types_from_string
+from clic.tokenizer import types_from_string, split_separator
 
 
 def put_book(cur, book):
@@ -48,16 +49,20 @@ def put_book(cur, book):
             rvalues[0] if len(rvalues) > 0 else None,
         ) for off_start, off_end, *rvalues in book[rclass_name]))
 
-    # Tokenise each chapter text region and add it to the database
+    # Tokenise each chapter text region and add it to the database, along with
+    # the text between it and the next token
+    tokens = list(types_from_string(book['content'], offset=0))
     psycopg2.extras.execute_values(cur, """
-        INSERT INTO """ + token_tbl + """ (book_id, crange, ttype) VALUES %s
+        INSERT INTO """ + token_tbl + """ (book_id, crange, ttype, ttext, separator) VALUES %s
     """, ((
         book_id,
         psycopg2.extras.NumericRange(off_start, off_end),
         ttype,
-    ) for ttype, off_start, off_end in types_from_string(
-        book['content'],
-        offset=0
+        book['content'][off_start:off_end],
+        list(split_separator(book['content'][off_end:next_start])),
+    ) for (ttype, off_start, off_end), (_, next_start, _) in zip(
+        tokens,
+        tokens[1:] + [(None, len(book['content']), None)],
     )))
 
     # Finalise token import, let DB update metadata, indexes
@@ -101,3 +106,30 @@ def get_book(cur, book_id_name, content=False, regions=False):
             out[rclass_name].append((crange.lower, crange.upper, rvalue))
 
     return out
+
+
+def get_book_content(cur, book_id):
+    """
+    Get the content of a book as a string.
+
+    The content is fetched from the database once, then kept in the shared
+    on-disk cache (see `cache <../cache.py>`__) for all processes to use.
+    """
+    # Anything that could mean the content has changed has to be in the key
+    cur.execute("""
+        SELECT b.xmin
+             , (SELECT version FROM repository WHERE name = 'corpora') corpora_version
+          FROM book b
+         WHERE b.book_id = %(book_id)s
+    """, dict(
+        book_id=book_id,
+    ))
+    key = ('book_content_utf8', book_id) + cur.fetchone()
+
+    def write_content(f):
+        cur.execute("SELECT content FROM book WHERE book_id = %(book_id)s", dict(
+            book_id=book_id,
+        ))
+        f.write(cur.fetchone()[0].encode('utf8'))
+    with cache_file(key, write_content) as f:
+        return f.read().decode('utf8')
@@ -0,0 +1,148 @@
+"""
+clic.db.book_ttype: Type frequency statistics
+*********************************************
+
+When a book is imported, ``book_import_finalise`` adds every type in the book
+to the ``lexicon`` table, giving each an integer ``ttype_id``. It then counts
+how often each type occurs within each subset of the book, and stores it in
+the ``book_ttype`` table. These can then be used to estimate how expensive a
+search will be before doing it.
+
+The table also stores the sorted ``ordering`` of every token of that type,
+i.e. it is a positional index that concordance uses to find phrases, see
+`concordance <../concordance.py>`__.
+
+ttype_expand / ttype_frequencies
+================================
+
+These are the books we use for the below::
+
+    >>> db_cur = test_database(
+    ... alice='''
+    ... ‘Well!’ thought Alice to herself, ‘after such a fall as this, I shall
+    ... think nothing of tumbling down stairs! How brave they’ll all think me at
+    ... home! Why, I wouldn’t say anything about it, even if I fell off the top
+    ... of the house!’ (Which was very likely true.)
+    ... ''',
+    ...
+    ... willows='''
+    ... ‘Get off!’ spluttered the Rat, with his mouth full.
+    ...
+    ... ‘Thought I should find you here all right,’ said the Otter cheerfully.
+    ... ‘They were all in a great state of alarm along River Bank when I arrived
+    ... this morning.
+    ... ''')
+    >>> from clic.db.corpora import corpora_to_book_ids
+    >>> from clic.db.lookup import api_subset_lookup
+    >>> book_ids = corpora_to_book_ids(db_cur, ['alice', 'willows'])
+
+We get the total number of tokens matching each like expression, in the same
+order as they were given::
+
+    >>> ttype_frequencies(db_cur, book_ids, api_subset_lookup(db_cur)['all'], [
+    ...     'the', 'i', 'f%ll', 'mouse'])
+    [4, 5, 3, 0]
+
+...and this is restricted to the subset requested::
+
+    >>> ttype_frequencies(db_cur, book_ids, api_subset_lookup(db_cur)['quote'], [
+    ...     'the', 'i', 'f%ll', 'mouse'])
+    [2, 4, 2, 0]
+
+Like expressions that match everything are not counted, we return None instead::
+
+    >>> ttype_frequencies(db_cur, book_ids, api_subset_lookup(db_cur)['all'], [
+    ...     '%', 'mouse'])
+    [None, 0]
+
+These come from expanding each like expression into the types it matches,
+using the lexicon. We get a dict of ``ttype_id`` to frequency for each, ``f%ll``
+matches "fall", "fell" and "full"::
+
+    >>> expansions = ttype_expand(db_cur, book_ids, api_subset_lookup(db_cur)['all'], [
+    ...     'f%ll', 'mouse', '%'])
+    >>> [None if e is None else sorted(e.values()) for e in expansions]
+    [[1, 1, 1], [], None]
+
+Types only in the lexicon because of other books / subsets aren't included,
+"full" isn't in a quote::
+
+    >>> expansions = ttype_expand(db_cur, book_ids, api_subset_lookup(db_cur)['quote'], [
+    ...     'f%ll'])
+    >>> [None if e is None else sorted(e.values()) for e in expansions]
+    [[1, 1]]
+
+If an expression matches too many types, we give up::
+
+    >>> ttype_expand(db_cur, book_ids, api_subset_lookup(db_cur)['all'], [
+    ...     'f%ll'], max_ttypes=2)
+    Traceback (most recent call last):
+      ...
+    clic.errors.UserError: The search term "f*ll" matches too many different words, please make it more specific
+"""
+from clic.errors import UserError
+
+#: Maximum number of types a query term can expand to before we refuse to search
+MAX_TTYPE_EXPANSION = 1000
+
+
+def ttype_expand(cur, book_ids, rclass_id, likes, max_ttypes=MAX_TTYPE_EXPANSION):
+    """
+    Expand each of (likes) into the types it matches in the given books & region.
+    Returns a list with, for each like expression, a dict of ttype_id -> frequency.
+
+    - book_ids: Book IDs to search within
+    - rclass_id: Region class to search within, e.g. from ``api_subset_lookup()``
+    - likes: List of LIKE expressions, as generated by ``parse_query()``
+    - max_ttypes: Raise a UserError if an expression matches more types than this
+
+    Expressions that would match every type (i.e. ``%``) are not expanded, and
+    None is returned in their place.
+    """
+    out = []
+    for like in likes:
+        if like.strip('%') == '':
+            out.append(None)
+            continue
+
+        cur.execute("""
+            SELECT bt.ttype_id
+                 , SUM(bt.ttype_count) ttype_count
+              FROM lexicon l, book_ttype bt
+             WHERE l.ttype LIKE %(like)s
+               AND bt.ttype_id = l.ttype_id
+               AND bt.book_id IN %(book_ids)s
+               AND bt.rclass_id = %(rclass_id)s
+          GROUP BY bt.ttype_id
+             LIMIT %(limit)s
+        """, dict(
+            like=like,
+            book_ids=tuple(book_ids),
+            rclass_id=rclass_id,
+            limit=max_ttypes + 1,
+        ))
+        out.append(dict((ttype_id, int(ttype_count)) for ttype_id, ttype_count in cur))
+
+        if len(out[-1]) > max_ttypes:
+            raise UserError('The search term "%s" matches too many different words, please make it more specific' % (
+                like.replace('%', '*').replace('_', '?')
+            ), "error")
+    return out
+
+
+def ttype_frequencies(cur, book_ids, rclass_id, likes):
+    """
+    Return a list with the number of tokens matching each of (likes) in the
+    given books & region.
+
+    - book_ids: Book IDs to count within
+    - rclass_id: Region class to count within, e.g. from ``api_subset_lookup()``
+    - likes: List of LIKE expressions, as generated by ``parse_query()``
+
+    Expressions that would match every type (i.e. ``%``) are not counted, and
+    None is returned in their place.
+    """
+    return [
+        None if e is None else sum(e.values())
+        for e in ttype_expand(cur, book_ids, rclass_id, likes)
+    ]
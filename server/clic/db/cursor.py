@@ -2,20 +2,34 @@
 clic.db.cursor: Connect to CLiC DB
 **********************************
 '''
+import concurrent.futures
 import contextlib
+import heapq
+import itertools
 import os
 import logging
+import queue
 import time
 import threading
 
 import psycopg2
-from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 from psycopg2.extras import MinTimeLoggingConnection as BaseLoggingConnection
 
 import appconfig
 
 _pool = None
 _pool_lock = threading.Lock()
+_cursor_names = itertools.count()
+
+#: Default number of rows to fetch at a time from a server-side cursor
+DEFAULT_ITERSIZE = 2000
+
+#: Maximum number of connections in our pool
+POOL_MAXCONN = 10
+
+#: Default number of connections a request can search with in parallel
+DEFAULT_WORKERS = 3
 
 logger = logging.getLogger(__name__)
 explain_logger = logging.getLogger(__name__ + '.explain')
@@ -35,6 +49,8 @@ class LoggingConnection(BaseLoggingConnection):
         if explain_logger.isEnabledFor(logging.DEBUG):
             if msg.startswith("EXPLAIN "):
                 return None  # Avoid infinite recursion
+            if msg.startswith("DECLARE "):
+                return msg  # Server-side cursor, can't explain the DECLARE
             explain_cur = cur.connection.cursor()
             explain_cur.execute("EXPLAIN " + msg)
             explain_logger.debug("\n" + "\n".join(x[0] for x in explain_cur.fetchall()))
@@ -54,8 +70,9 @@ def get_pool_cursor():
         with _pool_lock:
             if _pool is None:
                 _pool = ThreadedConnectionPool(
-                    minconn=1,
-                    maxconn=10,
+                    # Keep enough connections for a request's workers, rather than reconnecting each time
+                    minconn=max(pool_workers('CONCORDANCE_WORKERS'), pool_workers('KEYWORD_WORKERS')),
+                    maxconn=POOL_MAXCONN,
                     dsn=os.environ.get('DB_DSN', appconfig.DB_DSN),
                     connection_factory=LoggingConnection
                 )
@@ -77,6 +94,120 @@ def put_pool_cursor(cur):
     _pool.putconn(conn)
 
 
+def pool_workers(env_var):
+    """
+    Return the number of connections to work with in parallel, from (env_var)
+    or DEFAULT_WORKERS. This is never more than POOL_MAXCONN - 1, so one
+    request can't use up the whole pool. With several requests at once, the
+    pool may still run out, in which case pool_cursors() uses fewer.
+    """
+    return max(1, min(int(os.environ.get(env_var, DEFAULT_WORKERS)), POOL_MAXCONN - 1))
+
+
+@contextlib.contextmanager
+def pool_cursors(cur, workers):
+    """
+    Borrow up to (workers - 1) extra cursors from the pool, yielding a list of
+    (cur) followed by the extra cursors. If the pool doesn't have enough spare
+    connections, fewer are used. The extra cursors are put back afterwards.
+    """
+    curs = [cur]
+    try:
+        while len(curs) < workers:
+            try:
+                curs.append(get_pool_cursor())
+            except PoolError:
+                break  # Pool exhausted, make do with what we have
+        yield curs
+    finally:
+        for c in curs[1:]:
+            put_pool_cursor(c)
+
+
+def pool_map(cur, fn, items, workers):
+    """
+    Call fn(cur, item) for each of (items), returning a list of results in the
+    same order as (items).
+
+    Up to (workers - 1) extra cursors are borrowed from the pool, so items can be
+    processed in parallel alongside (cur). If the pool doesn't have enough spare
+    connections, fewer are used.
+    """
+    with pool_cursors(cur, min(workers, len(items))) as curs:
+        if len(curs) == 1:
+            return [fn(cur, item) for item in items]
+
+        # Each thread takes a free cursor, and returns it when done
+        free_curs = queue.Queue()
+        for c in curs:
+            free_curs.put(c)
+
+        def call_fn(item):
+            c = free_curs.get()
+            try:
+                return fn(c, item)
+            finally:
+                free_curs.put(c)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(curs)) as executor:
+            return list(executor.map(call_fn, items))
+
+
+def server_side_rows(cur, query, params, itersize=None):
+    """
+    Execute (query) with a server-side (named) cursor on (cur)'s connection, and
+    yield each row. Rows are fetched (itersize) at a time, defaulting to the
+    CURSOR_ITERSIZE environment variable, so the whole result set is never held
+    in memory at once.
+
+    Since the cursor lives within the current transaction, (cur) can still be
+    used for other queries whilst iterating.
+    """
+    named_cur = cur.connection.cursor(name='clic_%d' % next(_cursor_names))
+    named_cur.itersize = itersize or int(os.environ.get('CURSOR_ITERSIZE', DEFAULT_ITERSIZE))
+    try:
+        named_cur.execute(query, params)
+        yield from named_cur
+    finally:
+        named_cur.close()
+
+
+def merged_server_side_rows(curs, query, params_list, key, itersize=None):
+    """
+    Execute (query) once for each of (params_list), each with a server-side
+    cursor on the matching cursor of (curs)'s connection, and yield all rows
+    merged into order by (key). Each query's rows should already be in order.
+
+    Rows are fetched (itersize) at a time, as with server_side_rows(). Whilst
+    rows are being consumed, the next lot are fetched in a background thread,
+    so the queries run in parallel but are never all held in memory at once.
+    """
+    itersize = itersize or int(os.environ.get('CURSOR_ITERSIZE', DEFAULT_ITERSIZE))
+
+    def fetch_ahead(named_cur, future):
+        while True:
+            rows = future.result()
+            if not rows:
+                return
+            future = executor.submit(named_cur.fetchmany, itersize)
+            yield from rows
+
+    named_curs = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(params_list)) as executor:
+            for c, params in zip(curs, params_list):
+                named_curs.append(c.connection.cursor(name='clic_%d' % next(_cursor_names)))
+                named_curs[-1].execute(query, params)
+            # NB: Start fetching from every cursor before merge waits on any of them
+            yield from heapq.merge(*[
+                fetch_ahead(n, executor.submit(n.fetchmany, itersize)) for n in named_curs
+            ], key=key)
+    finally:
+        # NB: Leaving the executor waits for any fetches still running
+        for n in named_curs:
+            n.close()
+
+
 @contextlib.contextmanager
 def get_script_cursor(for_write=False):
     """Return a single cursor for a short-lived script"""
@@ -0,0 +1,227 @@
+"""
+clic.distribution: Distribution endpoint
+****************************************
+
+Counts where in each book the hits for a search are, e.g. for a dispersion plot.
+
+- corpora: 1+ corpus name (e.g. 'dickens') or book name ('AgnesG') to search within
+- subset: subset to search through, one of shortsus/longsus/nonquote/quote/all. Default 'all' (i.e. all text)
+- q: 1+ string to search for, as per concordance. Hits of all are combined
+- bin: Optional, also count hits within each (bin)-token section of the book
+- metadata: Optional data to return, see `book_metadata.py <db/book_metadata.py>`__ for all options.
+
+Parameters should be provided in querystring format, for example::
+
+    ?corpora=dickens&q=the+fog&bin=1000
+
+Returns a ``data`` array, one entry per book (including books without hits). Each item is an array of:
+
+* The book ID
+* Total hits in the book
+* Word count of the subset in the book
+* An array of ``[chapter number, hits, word count of the subset in the chapter]``, one for each chapter
+* If ``bin`` was given, an array of hits in each bin. Bins are counted from
+  the start of the book, including the title & chapter headings.
+
+Examples:
+
+``/api/distribution?corpora=AgnesG&q=the+fog``::
+
+    {"data":[
+        ["AgnesG",2,68197,[[1,0,4123],[2,1,3350],[3,0,5562],[4,1,3892], . . .]]
+    ], "version":{"corpora":"master:2affe56","clic:import":"1.6:876222b","clic":"1.7beta2:a1f93e7"}}
+
+Method
+------
+
+1. Find the nodes for each query with the concordance query (steps 2--6 of
+   `concordance <concordance.py>`__).
+
+2. Look up the chapter of each node's first token, and group the nodes by
+   book, chapter and bin in the database.
+
+3. Fetch word counts for each book & chapter, as per ``granularity=chapter``
+   in `count <count.py>`__.
+
+Examples / edge cases
+---------------------
+
+These are the corpora we use for the following tests::
+
+    >>> db_cur = test_database(
+    ... alice='''
+    ... Alice’s Adventures in Wonderland
+    ... Lewis Carroll
+    ...
+    ... CHAPTER I. Down the Rabbit-Hole
+    ...
+    ... ‘Well!’ thought Alice to herself, ‘after such a fall as this, I shall
+    ... think nothing of tumbling down stairs! How brave they’ll all think me at
+    ... home! Why, I wouldn’t say anything about it, even if I fell off the top
+    ... of the house!’ (Which was very likely true.)
+    ...
+    ... ‘I beg your pardon,’ said Alice very humbly: ‘you had got to the fifth
+    ... bend, I think?’
+    ...
+    ... CHAPTER II. The Pool of Tears
+    ...
+    ... ‘I had NOT!’ cried the Mouse, sharply and very angrily.
+    ... '''.strip(),
+    ...
+    ... willows='''
+    ... The Wind in the Willows
+    ... Kenneth Grahame
+    ...
+    ... CHAPTER I. THE RIVER BANK
+    ...
+    ... ‘Hold up!’ said an elderly rabbit at the gap. ‘Sixpence for the
+    ... privilege of passing by the private road!’
+    ...
+    ... CHAPTER IV. MR. BADGER
+    ...
+    ... ‘Thought I should find you here all right,’ said the Otter cheerfully.
+    ... ‘They were all in a great state of alarm along River Bank when I arrived
+    ... this morning.’
+    ... '''.strip(),
+    ...
+    ... mat='''
+    ... The cat sat on the mat.
+    ... '''.strip())
+
+We get hits per book, and per chapter. Word counts match ``word_count_chapter``::
+
+    >>> for x in distribution(db_cur, ['alice', 'willows'], q=['the']):
+    ...     print(x)
+    ['alice', 4, 76, [[1, 3, 66], [2, 1, 10]]]
+    ['willows', 4, 48, [[1, 3, 19], [2, 1, 29]]]
+
+Hits for all queries are combined, and chapters without hits are still returned::
+
+    >>> for x in distribution(db_cur, ['alice', 'willows'], q=['alice', 'rabbit']):
+    ...     print(x)
+    ['alice', 2, 76, [[1, 2, 66], [2, 0, 10]]]
+    ['willows', 1, 48, [[1, 1, 19], [2, 0, 29]]]
+
+Word counts, including chapter word counts, are for the subset requested::
+
+    >>> for x in distribution(db_cur, ['alice', 'willows'], subset=['quote'], q=['the']):
+    ...     print(x)
+    ['alice', 3, 56, [[1, 3, 53], [2, 0, 3]]]
+    ['willows', 2, 37, [[1, 2, 12], [2, 0, 25]]]
+
+Hits can also be counted in bins of a fixed number of tokens::
+
+    >>> for x in distribution(db_cur, ['alice', 'willows'], q=['the'], bin=['20']):
+    ...     print(x)
+    ['alice', 4, 76, [[1, 3, 66], [2, 1, 10]], [0, 0, 2, 1, 1]]
+    ['willows', 4, 48, [[1, 3, 19], [2, 1, 29]], [1, 2, 1, 0]]
+
+Books without any hits are returned too::
+
+    >>> for x in distribution(db_cur, ['alice', 'willows'], q=['mouse'], bin=['50']):
+    ...     print(x)
+    ['alice', 1, 76, [[1, 0, 66], [2, 1, 10]], [0, 1]]
+    ['willows', 0, 48, [[1, 0, 19], [2, 0, 29]], [0, 0]]
+
+The first bin starts at the first token, and a book that is an exact
+multiple of the bin size doesn't get an extra empty bin::
+
+    >>> for x in distribution(db_cur, ['mat'], q=['the'], bin=['3']):
+    ...     print(x)
+    ['mat', 2, 6, [[0, 2, 6]], [1, 1]]
+"""
+from clic.concordance import node_query, parse_query
+from clic.count import count_chapter
+from clic.db.book_metadata import get_book_metadata
+from clic.db.corpora import corpora_to_book_ids
+from clic.db.lookup import api_subset_lookup, rclass_id_lookup
+from clic.errors import UserError
+
+
+def distribution(cur, corpora=['dickens'], subset=['all'], q=[], bin=[], metadata=[]):
+    """
+    Get hit counts for each book / chapter / bin
+
+    - corpora: List of corpora / book names
+    - subset: Subset to search within, or 'all'
+    - q: Quer(ies) to search for, hits for all are combined
+    - bin: Size of bins in tokens, default no bins
+    - metadata, Array of extra metadata to provide with result, some of
+      - 'book_titles' (return dict of book IDs to titles at end of result)
+    """
+    book_ids = tuple(corpora_to_book_ids(cur, corpora))
+    if len(book_ids) == 0:
+        raise UserError("No books to search", "error")
+    api_subset = api_subset_lookup(cur)
+    rclass = rclass_id_lookup(cur)
+    rclass_ids = tuple(api_subset[s] for s in subset)
+    if len(rclass_ids) != 1:
+        raise UserError("You must supply exactly one subset", "error")
+    like_sets = [parse_query(s) for s in q]
+    if len(like_sets) == 0:
+        raise UserError("You must supply at least one search term", "error")
+    bin = int(bin[0]) if bin else None
+    if bin is not None and bin < 1:
+        raise UserError("Bin size must be at least 1", "error")
+
+    # Word counts for each book & chapter, which also gives us every book & chapter to return
+    chapters = {}
+    for name, chapter_num, word_count in count_chapter(cur, book_ids, rclass_ids, rclass['chapter.text']):
+        chapters.setdefault(name, []).append((chapter_num, word_count))
+    cur.execute("""
+        SELECT b.book_id
+             , b.name
+             , (SELECT COALESCE(SUM(bwc.word_count), 0)
+                  FROM book_word_count bwc
+                 WHERE bwc.book_id = b.book_id
+                   AND bwc.rclass_id = %(rclass_id)s) word_count
+             , (SELECT MAX(t.ordering) FROM token t WHERE t.book_id = b.book_id) max_ordering
+          FROM book b
+         WHERE b.book_id IN %(book_ids)s
+      ORDER BY b.name
+    """, dict(
+        book_ids=book_ids,
+        rclass_id=rclass_ids[0],
+    ))
+    books = cur.fetchall()
+
+    # Group hits by book, chapter and bin
+    hits = {}
+    query, params, _ = node_query(cur, book_ids, rclass_ids[0], like_sets)
+    if query:
+        params['bin'] = bin or 1
+        cur.execute("""
+            WITH nodes AS (""" + query + """)
+            SELECT m.book_id
+                 , t.chapter chapter_num
+                 , """ + ("(m.node_ordering - 1) / %(bin)s" if bin else "0") + """ bin
+                 , COUNT(*) hits
+              FROM nodes m
+              JOIN token t ON t.book_id = m.book_id AND t.ordering = m.node_ordering
+          GROUP BY 1, 2, 3
+        """, params)
+        for book_id, chapter_num, bin_num, count in cur:
+            hits.setdefault(book_id, []).append((chapter_num, bin_num, int(count)))
+
+    for book_id, name, word_count, max_ordering in books:
+        chapter_hits = {}
+        # NB: Orderings start at 1
+        bin_hits = [0] * (((max_ordering or 0) - 1) // bin + 1) if bin else None
+        for chapter_num, bin_num, count in hits.get(book_id, []):
+            chapter_hits[chapter_num] = chapter_hits.get(chapter_num, 0) + count
+            if bin:
+                bin_hits[bin_num] += count
+
+        out = [
+            name,
+            sum(chapter_hits.values()),
+            int(word_count),
+            [[chapter_num, chapter_hits.get(chapter_num, 0), chapter_words] for chapter_num, chapter_words in chapters.get(name, [])],
+        ]
+        if bin:
+            out.append(bin_hits)
+        yield out
+
+    footer = get_book_metadata(cur, book_ids, set(metadata))
+    if footer:
+        yield ('footer', footer)
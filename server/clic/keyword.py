@@ -51,12 +51,33 @@ Or using text files as input:
                      round_values=True,)
 
 '''
+import collections
+import os
+
 import pandas as pd
 import numpy as np
 
-from clic.cluster import get_word_list
+from clic.cache import cache_file, cache_path, LRUCache
+from clic.cluster import get_word_list, MAX_STORED_CLUSTERLENGTH
 from clic.db.corpora import corpora_to_book_ids
+from clic.db.cursor import pool_map, pool_workers, server_side_rows
 from clic.db.lookup import api_subset_lookup
+from clic.errors import UserError
+
+#: Approximate bytes of reference word lists each process keeps in memory
+REFERENCE_WORD_LISTS_SIZE = 256 * 1024 ** 2
+
+_reference_word_lists = LRUCache(REFERENCE_WORD_LISTS_SIZE, size_fn=lambda value: (
+    value[0].memory_usage(deep=True) + value[1].nbytes
+))
+
+#: Minimum LL value for each p-value
+P_VALUE_LL = {
+    0.0001: 15.13,
+    0.001: 10.83,
+    0.01: 6.63,
+    0.05: 3.84,
+}
 
 
 def keyword(
@@ -64,11 +85,21 @@ def keyword(
         clusterlength,
         pvalue,
         subset=['all'], corpora=['dickens'],
-        refsubset=['all'], refcorpora=['dickens']):
+        refsubset=['all'], refcorpora=['dickens'],
+        refmode=['whole']):
     '''
     Main entry,
+
+    - refmode: 'whole' (default) to compare against all of the reference
+      books, or 'rest' to leave out any books being analysed, e.g. to compare
+      a book against the rest of its corpus
+
+    The word lists are fetched in parallel on up to ``KEYWORD_WORKERS``
+    connections from the pool (default 3, set to 1 to turn off).
     '''
     # Defaults / dereference arrays
+    if refmode[0] not in ('whole', 'rest'):
+        raise UserError('Unknown refmode "%s", should be whole or rest' % refmode[0], "error")
     book_ids = corpora_to_book_ids(cur, corpora)
     refbook_ids = corpora_to_book_ids(cur, refcorpora)
     pvalue = float(pvalue[0])
@@ -77,10 +108,37 @@ def keyword(
     rclass_ids = tuple(api_subset[s] for s in subset)
     refrclass_ids = tuple(api_subset[s] for s in refsubset)
 
-    wordlist_analysis = facets_to_df(get_word_list(cur, book_ids, rclass_ids, clusterlength))
+    # Fetch the word lists we need from the database, at the same time if
+    # KEYWORD_WORKERS allows. A cached reference word list doesn't need fetching
+    ref_key = reference_word_list_key(cur, refbook_ids, refrclass_ids, clusterlength)
+    fetches = collections.OrderedDict((
+        # Most frequent first, so the first 3000 keywords are the most frequent
+        ('analysis', lambda c: word_list_df(get_word_list(c, book_ids, rclass_ids, clusterlength, sort='freq')[0])),
+    ))
+    if not reference_word_list_cached(ref_key):
+        fetches['reference'] = lambda c: get_reference_word_list(c, refbook_ids, refrclass_ids, clusterlength, key=ref_key)
+    overlap_ids = set(book_ids) & set(refbook_ids)
+    if refmode[0] == 'rest' and overlap_ids and (overlap_ids != set(book_ids) or refrclass_ids != rclass_ids):
+        # Fetch the overlapping books from the reference subset, to take away
+        # from the reference word list below
+        fetches['overlap'] = lambda c: word_list_df(get_word_list(c, sorted(overlap_ids), refrclass_ids, clusterlength)[0])
+    workers = pool_workers('KEYWORD_WORKERS')
+    fetched = dict(zip(fetches.keys(), pool_map(cur, lambda c, fn: fn(c), list(fetches.values()), workers)))
+    wordlist_analysis = fetched['analysis']
+    if 'reference' in fetched:
+        wordlist_reference = fetched['reference']
+    else:
+        wordlist_reference = get_reference_word_list(cur, refbook_ids, refrclass_ids, clusterlength, key=ref_key)
     total_analysis = wordlist_analysis.Count.sum()
 
-    wordlist_reference = facets_to_df(get_word_list(cur, refbook_ids, refrclass_ids, clusterlength))
+    if refmode[0] == 'rest' and overlap_ids:
+        # Take the overlapping books out of the (cached) reference word list,
+        # rather than fetching a word list for the rest of the reference. If
+        # they're the books we're analysing, we already have their counts
+        wordlist_reference = subtract_word_list(
+            wordlist_reference,
+            fetched.get('overlap', wordlist_analysis),
+        )
     total_reference = wordlist_reference.Count.sum()
 
     try:
@@ -119,6 +177,109 @@ The results are limited to 3000 rows. Generally there will be fewer results. Onl
         yield tuple(x for x in k)
 
 
+def keyword_matrix(
+        cur,
+        clusterlength=['1'], pvalue=['0.0001'],
+        subset=['all'], corpora=['dickens'],
+        limit=['20']):
+    '''
+    Keywords for every book in (corpora), each compared against the rest of
+    the books, i.e. the same as keyword() with refmode=rest for each book in turn
+
+    - clusterlength, pvalue, subset: As per keyword()
+    - corpora: List of corpora / book names, at least 2 books
+    - limit: Number of keywords to return for each book, highest LL first
+
+    Yields one row per book, ordered by name::
+
+        [book name, word count, [[type, count, count in rest of corpus, LL], ...]]
+
+    Rather than fetching a word list for each book and the rest of the corpus,
+    we build a (book, type) count matrix once from ``book_ngram`` in a single
+    query, and compute LL for every non-zero cell together with
+    log_likelihood_arrays().
+    '''
+    # Defaults / dereference arrays
+    pvalue = float(pvalue[0])
+    clusterlength = int(clusterlength[0])
+    api_subset = api_subset_lookup(cur)
+    rclass_ids = tuple(api_subset[s] for s in subset)
+    limit = int(limit[0])
+    book_ids = tuple(set(corpora_to_book_ids(cur, corpora)))
+    if len(book_ids) < 2:
+        raise UserError("You must supply at least 2 books to compare", "error")
+
+    cur.execute("""
+        SELECT b.book_id
+             , b.name
+          FROM book b
+         WHERE b.book_id IN %(book_ids)s
+      ORDER BY b.name
+    """, dict(
+        book_ids=book_ids,
+    ))
+    books = cur.fetchall()
+
+    # Non-zero cells of the (book, type) count matrix, all fetched at once
+    if len(rclass_ids) != 1:
+        raise NotImplementedError()
+    if clusterlength > MAX_STORED_CLUSTERLENGTH:
+        # Longer clusters aren't stored, so have to be counted book by book
+        cells = (
+            (book_id, t, c)
+            for book_id, _ in books
+            for t, c in get_word_list(cur, [book_id], rclass_ids, clusterlength)[0]
+        )
+    else:
+        cells = server_side_rows(cur, """
+            SELECT bn.book_id
+                 , bn.ngram
+                 , bn.ngram_count
+              FROM book_ngram bn
+             WHERE bn.book_id IN %(book_ids)s
+               AND bn.rclass_id = %(rclass_id)s
+               AND bn.ngram_length = %(clusterlength)s
+        """, dict(
+            book_ids=book_ids,
+            rclass_id=rclass_ids[0],
+            clusterlength=clusterlength,
+        ))
+    book_index = {book_id: i for i, (book_id, _) in enumerate(books)}
+    cell_book, cell_type, cell_count = [], [], []
+    for book_id, t, c in cells:
+        cell_book.append(book_index[book_id])
+        cell_type.append(t)
+        cell_count.append(c)
+    cell_book = np.array(cell_book, dtype=np.int64)
+    cell_count = np.array(cell_count, dtype=np.int64)
+    cell_type, types = pd.factorize(np.array(cell_type, dtype=object), sort=True)
+
+    # Compare each cell to the same type in the rest of the corpus
+    book_totals = np.bincount(cell_book, weights=cell_count, minlength=len(books)).astype(np.int64)
+    type_totals = np.bincount(cell_type, weights=cell_count, minlength=len(types)).astype(np.int64)
+    count_a = cell_count
+    count_b = type_totals[cell_type] - cell_count
+    total_a = book_totals[cell_book]
+    total_b = book_totals.sum() - total_a
+    expected_a, _, ll = log_likelihood_arrays(count_a, count_b, total_a, total_b)
+
+    # Filter as extract_keywords() would, then choose the top (limit) of each book
+    wanted = (count_a >= 5) & (count_a > expected_a)
+    if pvalue in P_VALUE_LL:
+        wanted &= ll >= P_VALUE_LL[pvalue]
+    cells = np.flatnonzero(wanted)
+    cells = cells[np.lexsort((cell_type[cells], -count_a[cells], -ll[cells], cell_book[cells]))]
+    first_cell = np.searchsorted(cell_book[cells], cell_book[cells])
+    cells = cells[np.arange(len(cells)) - first_cell < limit]
+
+    book_cells = np.split(cells, np.searchsorted(cell_book[cells], np.arange(1, len(books))))
+    for (book_id, name), total, cells in zip(books, book_totals, book_cells):
+        yield [name, int(total), [
+            [types[cell_type[c]], int(count_a[c]), int(count_b[c]), round(float(ll[c]), 2)]
+            for c in cells
+        ]]
+
+
 def log_likelihood(counts):
     '''
     This function uses vector calculations to compute LL values.
@@ -146,27 +307,37 @@ def log_likelihood(counts):
     It is expected that Count_analysis and Expected_count_analysis are not zero.
     '''
 
-    # compute expected values
-    counts.loc[:, 'Expected_count_analysis'] = counts['Total_analysis'] * (counts['Count_analysis'] + counts['Count_ref']) / (counts['Total_analysis'] + counts['Total_ref'])
-    counts.loc[:, 'Expected_count_ref'] = counts['Total_ref'] * (counts['Count_analysis'] + counts['Count_ref']) / (counts['Total_analysis'] + counts['Total_ref'])
+    expected_a, expected_b, ll = log_likelihood_arrays(
+        counts['Count_analysis'].values,
+        counts['Count_ref'].values,
+        counts['Total_analysis'].values,
+        counts['Total_ref'].values,
+    )
+    counts.loc[:, 'Expected_count_analysis'] = expected_a
+    counts.loc[:, 'Expected_count_ref'] = expected_b
+    counts.loc[:, 'LL'] = ll
 
-    # define variables to avoid cluttering
-    a = counts['Count_analysis']
-    exp_a = counts['Expected_count_analysis']
-    b = counts['Count_ref']
-    exp_b = counts['Expected_count_ref']
+    return counts
 
-    # log likelihood if count or expected count in the ref corpus are 0
-    # the order of the LL computation is important
-    # these cases do NOT handle wordlists where the type does not occur in the corpus of analysis
-    counts.loc[(b == 0) | (exp_b == 0), 'LL'] = 2 * (a * np.log(a / exp_a))
 
-    # compute log likelihood for normal cases
-    # do not use the following as it will overwrite the specific cases above:
-    # counts.loc[:,'LL'] = 2*((a * np.log(a/exp_a)) + (b * np.log(b/exp_b)))
-    counts.loc[(b != 0) & (exp_b != 0), 'LL'] = 2 * ((a * np.log(a / exp_a)) + (b * np.log(b / exp_b)))
+def log_likelihood_arrays(count_a, count_b, total_a, total_b):
+    '''
+    The computation behind log_likelihood(), for NumPy arrays of counts in the
+    corpus of analysis (count_a) & reference (count_b) and totals.
 
-    return counts
+    Returns a tuple of arrays: expected count analysis, expected count ref, LL
+    '''
+    # compute expected values
+    expected_a = total_a * (count_a + count_b) / (total_a + total_b)
+    expected_b = total_b * (count_a + count_b) / (total_a + total_b)
+
+    # log likelihood if count or expected count in the ref corpus are 0
+    # these cases do NOT handle wordlists where the type does not occur in the corpus of analysis
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ll_a = count_a * np.log(count_a / expected_a)
+        ll_b = count_b * np.log(count_b / expected_b)
+    ll = np.where((count_b == 0) | (expected_b == 0), 2 * ll_a, 2 * (ll_a + ll_b))
+    return expected_a, expected_b, ll
 
 
 def extract_keywords(wordlist_analysis,
@@ -186,6 +357,10 @@ def extract_keywords(wordlist_analysis,
     Input = Two dataframes with columns 'Type', and 'Count' and
             two total tokencounts
 
+    The reference counts are aligned to the types of wordlist_analysis by their
+    position in wordlist_reference, and the computation is done on NumPy arrays.
+    Only the rows that survive the filtering below are turned into a dataframe.
+
     Output = An aligned dataframe which is sorted on the LL value and maybe filter
              using the following handles:
 
@@ -221,77 +396,152 @@ def extract_keywords(wordlist_analysis,
     frequency rank of the token in the corpus of analysis).
     '''
 
-    # select only the Type and Count columns
-    wordlist_analysis = wordlist_analysis[['Type', 'Count']]
-    wordlist_reference = wordlist_reference[['Type', 'Count']]
-
     # limit with a simple frequency cut-off, does not filter the corpus of reference
-    wordlist_analysis = wordlist_analysis.loc[wordlist_analysis.Count >= freq_cut_off]
+    types = np.asarray(wordlist_analysis['Type'])
+    count_a = np.asarray(wordlist_analysis['Count'])
+    types, count_a = types[count_a >= freq_cut_off], count_a[count_a >= freq_cut_off]
 
-    # merge and align the two wordlists
-    merged = wordlist_analysis.merge(wordlist_reference, on='Type', how='left', suffixes=('_analysis', '_ref')).fillna(0)
-    # float64 to int64 because pandas int64 does not handle NaN
-    merged.loc[:, 'Count_ref'] = merged['Count_ref'].astype(int)
+    # align the reference counts with the analysis types by their position in
+    # the reference word list, types not in the reference point at a trailing 0
+    ref_positions = type_index(wordlist_reference).get_indexer(types)
+    count_b = np.append(np.asarray(wordlist_reference['Count'], dtype=np.int64), 0)[ref_positions]
 
     # prepare object for computation
     if not tokencount_analysis:
         raise IOError('You did not provide a total token count for the corpus of analysis')
-    merged.loc[:, 'Total_analysis'] = tokencount_analysis
-
     if not tokencount_reference:
         raise IOError('You did not provide a total token count for the corpus of reference')
-    merged.loc[:, 'Total_ref'] = tokencount_reference
-    keywords = merged.loc[:, ['Type', 'Count_analysis', 'Total_analysis', 'Count_ref', 'Total_ref']]
 
     # compute keyness
-    keywords = log_likelihood(keywords)
-
-    # over and underused
-    keywords.loc[:, 'Use'] = '0'
-    keywords.loc[keywords.Count_analysis > keywords.Expected_count_analysis, 'Use'] = '+'
-    keywords.loc[keywords.Count_analysis < keywords.Expected_count_analysis, 'Use'] = '-'
+    expected_a, expected_b, ll = log_likelihood_arrays(count_a, count_b, tokencount_analysis, tokencount_reference)
 
+    # over and underused, limit the keywords to the p-value
+    # if the p cut-off does not match either of the conditions, no filtering is done
+    wanted = np.ones(len(types), dtype=bool)
     if exclude_underused:
-        keywords = keywords.loc[keywords['Use'] == '+', :]
+        wanted &= count_a > expected_a
+    if p_value in P_VALUE_LL:
+        wanted &= ll >= P_VALUE_LL[p_value]
+    rows = np.flatnonzero(wanted)
+    if limit_rows:
+        rows = rows[:limit_rows]
+
+    # Only build the output for the rows we're returning
+    count_a, expected_a, ll = count_a[rows], expected_a[rows], ll[rows]
+    keywords = pd.DataFrame(collections.OrderedDict((
+        ('Type', types[rows]),
+        ('Count_analysis', count_a),
+        ('Total_analysis', np.full(len(rows), tokencount_analysis)),
+        ('Count_ref', count_b[rows]),
+        ('Total_ref', np.full(len(rows), tokencount_reference)),
+        ('Expected_count_analysis', np.round(expected_a, 2) if round_values else expected_a),
+        ('Expected_count_ref', np.round(expected_b[rows], 2) if round_values else expected_b[rows]),
+        ('LL', np.round(ll, 2) if round_values else ll),
+        ('Use', np.select([count_a > expected_a, count_a < expected_a], ['+', '-'], default='0').astype(object)),
+        # translate LL value to p-value
+        ('p', np.select(
+            [ll >= P_VALUE_LL[p] for p in sorted(P_VALUE_LL)],
+            ['p < %s' % p for p in sorted(P_VALUE_LL)],
+            default='p >= 0.05',
+        ).astype(object)),
+    )), index=rows)
+    return keywords
 
-    # translate LL value to p-value
-    keywords.loc[:, 'p'] = 'p >= 0.05'
-    keywords.loc[keywords['LL'] >= 3.84, 'p'] = 'p < 0.05'
-    keywords.loc[keywords['LL'] >= 6.63, 'p'] = 'p < 0.01'
-    keywords.loc[keywords['LL'] >= 10.83, 'p'] = 'p < 0.001'
-    keywords.loc[keywords['LL'] >= 15.13, 'p'] = 'p < 0.0001'
 
-    # limit the keywords to the p-value
-    # if the p cut-off does not match either of the conditions, no filtering is done
-    if p_value == 0.0001:
-        keywords = keywords[keywords['LL'] >= 15.13]
-    if p_value == 0.001:
-        keywords = keywords[keywords['LL'] >= 10.83]
-    if p_value == 0.01:
-        keywords = keywords[keywords['LL'] >= 6.63]
-    if p_value == 0.05:
-        keywords = keywords[keywords['LL'] >= 3.84]
-
-    if round_values:
-        keywords = keywords.round({'LL': 2, 'Expected_count_analysis': 2, 'Expected_count_ref': 2})
+def reference_word_list_key(cur, book_ids, rclass_ids, clusterlength):
+    """
+    Return the cache key for a reference word list, see get_reference_word_list()
+    """
+    # Anything that could mean the word list has changed has to be in the key
+    cur.execute("""
+        SELECT ARRAY_AGG(b.book_id || ':' || b.xmin ORDER BY b.book_id) book_versions
+             , (SELECT version FROM repository WHERE name = 'corpora') corpora_version
+          FROM book b
+         WHERE b.book_id IN %(book_ids)s
+    """, dict(
+        book_ids=tuple(book_ids),
+    ))
+    book_versions, corpora_version = cur.fetchone()
+    return ('reference_word_list', tuple(book_versions or ()), tuple(rclass_ids), clusterlength, corpora_version)
+
+
+def reference_word_list_cached(key):
+    """
+    True iff the reference word list for (key) can be had without the database
+    """
+    return key in _reference_word_lists or os.path.exists(cache_path(key))
+
+
+def get_reference_word_list(cur, book_ids, rclass_ids, clusterlength, key=None):
+    """
+    Return word_list_df(get_word_list(...)) for a reference corpus.
+
+    The same few reference corpora are used over and over, and are generally
+    much bigger than the texts being analysed. So each word list is stored in
+    the shared on-disk cache (see `cache <cache.py>`__) as arrays of types &
+    counts. The most recent are kept in memory, up to REFERENCE_WORD_LISTS_SIZE
+    bytes, with the types as an index of the returned dataframe so it only
+    needs building once (see type_index()).
+
+    If already known, provide the reference_word_list_key() as (key).
+    """
+    if key is None:
+        key = reference_word_list_key(cur, book_ids, rclass_ids, clusterlength)
+
+    def write_word_list(f):
+        types, counts = [], []
+        for t, c in get_word_list(cur, book_ids, rclass_ids, clusterlength)[0]:
+            types.append(t)
+            counts.append(c)
+        np.savez(
+            f,
+            types=np.frombuffer("\n".join(types).encode('utf8'), dtype=np.uint8),
+            counts=np.array(counts, dtype=np.int64),
+        )
+
+    def read_word_list():
+        with cache_file(key, write_word_list) as f, np.load(f) as data:
+            counts = data['counts']
+            types = data['types'].tobytes().decode('utf8').split("\n") if len(counts) > 0 else []
+        return pd.Index(types, dtype=object, name='Type'), counts
+    types, counts = _reference_word_lists.get(key, read_word_list)
+
+    return pd.DataFrame(collections.OrderedDict((
+        ('Type', types.values),
+        ('Count', counts),
+    )), index=types)
+
+
+def subtract_word_list(wordlist, other):
+    '''
+    Take the counts in (other) away from (wordlist), both dataframes with
+    'Type' and 'Count' columns, e.g. to remove some books from a corpus' word
+    list. Types in (other) should all be in (wordlist). Types are kept even
+    if left with no count, so any index on (wordlist) can be reused.
+    '''
+    counts = np.array(wordlist['Count'], dtype=np.int64)
+    positions = type_index(wordlist).get_indexer(other['Type'])
+    counts[positions[positions >= 0]] -= np.asarray(other['Count'], dtype=np.int64)[positions >= 0]
+    return pd.DataFrame(collections.OrderedDict((
+        ('Type', wordlist['Type'].values),
+        ('Count', counts),
+    )), index=wordlist.index)
 
-    if limit_rows:
-        return keywords.iloc[:limit_rows]
 
-    return keywords
+def type_index(wordlist):
+    '''
+    Return a pd.Index of the types in (wordlist). If (wordlist) is already
+    indexed by 'Type', e.g. from get_reference_word_list(), we use that
+    rather than building a new one.
+    '''
+    if wordlist.index.name == 'Type':
+        return wordlist.index
+    return pd.Index(wordlist['Type'])
 
 
-def facets_to_df(facets):
+def word_list_df(word_list):
     '''
-    Converts the facets into a dataframe that can be manipulated
-    more easily.
+    Turn (type, count) tuples from get_word_list() into a dataframe with
+    'Type' and 'Count' columns
     '''
-    dataframe = pd.DataFrame(list(facets), columns=['Type', 'Count'])
-    dataframe.index += 1
-
-    total = dataframe.Count.sum()
-    dataframe['Percentage'] = dataframe.Count / total * 100
-    dataframe['Percentage'] = dataframe['Percentage'].round(decimals=2)
-    dataframe.sort_values(by='Count', ascending=False, inplace=True)
-    dataframe['Empty'] = ''
-    return dataframe
+    return pd.DataFrame(list(word_list), columns=['Type', 'Count'])
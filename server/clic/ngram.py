@@ -0,0 +1,205 @@
+"""
+clic.ngram: Count clusters with NumPy
+*************************************
+
+Counts clusters (n-grams) of types within books, without fetching any strings
+from the database until the end.
+
+The positional index in ``book_ttype`` (see `book_ttype <db/book_ttype.py>`__)
+stores the ``ordering`` of every token of each type within each subset of a
+book. From this we build 2 integer arrays for each book: the orderings of
+every token in the subset, and the ``ttype_id`` of each. Clusters are
+(length) consecutive entries where the orderings have no gaps, so they don't
+span regions. Each cluster is then given an integer key (see
+`cluster_keys`_), and the keys counted with ``np.unique``. Only clusters that
+meet the cutoff are converted back into strings using the lexicon.
+
+ngram_counts
+============
+
+These are the books we use for the below::
+
+    >>> db_cur = test_database(
+    ... alice='''
+    ... ‘Well!’ thought Alice to herself, ‘after such a fall as this, I shall
+    ... think nothing of tumbling down stairs! How brave they’ll all think me at
+    ... home! Why, I wouldn’t say anything about it, even if I fell off the top
+    ... of the house!’ (Which was very likely true.)
+    ... ''',
+    ...
+    ... willows='''
+    ... ‘Get off!’ spluttered the Rat, with his mouth full.
+    ...
+    ... ‘Thought I should find you here all right,’ said the Otter cheerfully.
+    ... ‘They were all in a great state of alarm along River Bank when I arrived
+    ... this morning.
+    ... ''')
+    >>> from clic.db.corpora import corpora_to_book_ids
+    >>> from clic.db.lookup import api_subset_lookup
+    >>> book_ids = corpora_to_book_ids(db_cur, ['alice', 'willows'])
+    >>> api_subset = api_subset_lookup(db_cur)
+
+We get each cluster and how often it occurs, and how many clusters were below
+the cutoff::
+
+    >>> clusters, totals = ngram_counts(db_cur, book_ids, api_subset['all'], 1, cutoff=3)
+    >>> sorted(clusters)
+    [('all', 3), ('i', 5), ('of', 3), ('the', 4)]
+    >>> totals
+    {'skipped': 67}
+
+We can ask for the most frequent clusters, ties are broken alphabetically::
+
+    >>> ngram_counts(db_cur, book_ids, api_subset['all'], 1, sort='freq', limit=3)
+    ([('i', 5), ('the', 4), ('all', 3)], {'skipped': 0, 'total': 71, 'total_with_ties': 4})
+
+Clusters are counted across all books, but don't span books or regions. "get
+off" and "off spluttered" are in different regions, so aren't counted in
+quotes::
+
+    >>> sorted(x for x in ngram_counts(db_cur, book_ids, api_subset['all'], 2)[0] if 'off' in x[0])
+    [('fell off', 1), ('get off', 1), ('off spluttered', 1), ('off the', 1)]
+    >>> sorted(x for x in ngram_counts(db_cur, book_ids, api_subset['quote'], 2)[0] if 'off' in x[0])
+    [('fell off', 1), ('get off', 1), ('off the', 1)]
+
+Longer clusters work the same way::
+
+    >>> sorted(ngram_counts(db_cur, corpora_to_book_ids(db_cur, ['alice']), api_subset['nonquote'], 4)[0])
+    [('thought alice to herself', 1), ('was very likely true', 1), ('which was very likely', 1)]
+
+If there's nothing to count, we get nothing back::
+
+    >>> ngram_counts(db_cur, book_ids, api_subset['shortsus'], 5)
+    ([], {'skipped': 0})
+
+cluster_keys
+============
+
+Given the ttype_ids of tokens and where each cluster starts, we get a key for
+each cluster, identical clusters getting the same key. The ttype_ids can be
+as big as a real lexicon's, and clusters as long as we like::
+
+    >>> ttype_ids = np.array([250001, 99, 250001, 99, 250001, 99, 250001, 180002])
+    >>> cluster_keys(ttype_ids, np.array([0, 2, 1, 3, 4]), 4).tolist()
+    [1, 1, 0, 0, 2]
+    >>> ttype_ids = np.array([250001, 99] * 20 + [180002])
+    >>> cluster_keys(ttype_ids, np.array([0, 2, 1, 11]), 30).tolist()
+    [2, 2, 1, 0]
+"""
+import numpy as np
+
+
+def book_tokens(cur, book_id, rclass_id):
+    """
+    Return a tuple of arrays (orderings, ttype_ids), for every token in
+    (rclass_id) of (book_id), in book order
+    """
+    cur.execute("""
+        SELECT bt.ttype_id
+             , bt.orderings
+          FROM book_ttype bt
+         WHERE bt.book_id = %(book_id)s
+           AND bt.rclass_id = %(rclass_id)s
+    """, dict(
+        book_id=book_id,
+        rclass_id=rclass_id,
+    ))
+    orderings = []
+    ttype_ids = []
+    for ttype_id, ords in cur:
+        orderings.append(np.array(ords, dtype=np.int64))
+        ttype_ids.append(np.full(len(ords), ttype_id, dtype=np.int64))
+    if len(orderings) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    orderings = np.concatenate(orderings)
+    ttype_ids = np.concatenate(ttype_ids)
+    order = np.argsort(orderings, kind='mergesort')
+    return orderings[order], ttype_ids[order]
+
+
+def cluster_keys(ttype_ids, starts, length):
+    """
+    Return an array of integer keys for each cluster of (length) tokens
+    beginning at each of (starts) in (ttype_ids), equal for equal clusters.
+
+    Rather than packing every ttype_id of a cluster into one integer, which
+    soon runs out of bits, we add one token at a time and replace the partial
+    keys with their rank. Keys are then always less than the number of
+    clusters, so (key * number of types + next ttype_id) never overflows.
+    """
+    types, ttype_ids = np.unique(ttype_ids, return_inverse=True)
+    ttype_ids = ttype_ids.reshape(-1)
+    keys = ttype_ids[starts]
+    for i in range(1, length):
+        keys = np.unique(keys * len(types) + ttype_ids[starts + i], return_inverse=True)[1].reshape(-1)
+    return keys
+
+
+def ngram_counts(cur, book_ids, rclass_id, length, cutoff=0, sort=None, limit=None):
+    """
+    Count every cluster of (length) types in (rclass_id) of (book_ids). Returns
+    a tuple of:
+
+    - A list of (cluster, count) for clusters occurring at least (cutoff) times
+    - A dict of totals, as per ``clic.cluster.get_word_list``
+
+    - sort: 'freq' to return the most frequent clusters first, ties in codepoint order
+    - limit: Only return this many clusters, implies sort='freq'
+    """
+    # Put all books end to end, leaving a gap in orderings so clusters don't span books
+    orderings, ttype_ids = [], []
+    offset = 0
+    for book_id in book_ids:
+        book_orderings, book_ttype_ids = book_tokens(cur, book_id, rclass_id)
+        if len(book_orderings) > 0:
+            orderings.append(book_orderings + offset)
+            ttype_ids.append(book_ttype_ids)
+            offset += int(book_orderings[-1]) + length
+    orderings = np.concatenate(orderings) if orderings else np.zeros(0, dtype=np.int64)
+    ttype_ids = np.concatenate(ttype_ids) if ttype_ids else np.zeros(0, dtype=np.int64)
+
+    # Clusters start wherever the next (length) tokens have no gaps
+    count = len(orderings) - length + 1
+    starts = np.flatnonzero(orderings[length - 1:] - orderings[:max(count, 0)] == length - 1)
+    if len(starts) == 0:
+        totals = dict(skipped=0)
+        if limit is not None:
+            totals.update(total=0, total_with_ties=0)
+        return [], totals
+    _, first, counts = np.unique(cluster_keys(ttype_ids, starts, length), return_index=True, return_counts=True)
+    first = starts[first]  # i.e. where an example of each cluster starts
+
+    # Choose the clusters we're returning
+    totals = dict(skipped=int(np.count_nonzero(counts < cutoff)))
+    first = first[counts >= cutoff]
+    counts = counts[counts >= cutoff]
+    if limit is not None:
+        totals['total'] = len(counts)
+        if len(counts) > limit:
+            # Keep everything at least as frequent as the (limit)th cluster,
+            # we can only break ties once we have the strings
+            last_count = np.partition(counts, len(counts) - limit)[len(counts) - limit]
+            first = first[counts >= last_count]
+            counts = counts[counts >= last_count]
+        totals['total_with_ties'] = len(counts)
+
+    # Look up strings for the types we need
+    clusters = np.stack([ttype_ids[first + i] for i in range(length)], axis=1)
+    cur.execute("""
+        SELECT l.ttype_id
+             , l.ttype
+          FROM lexicon l
+         WHERE l.ttype_id = ANY(%(ttype_ids)s)
+    """, dict(
+        ttype_ids=[int(x) for x in np.unique(clusters)],
+    ))
+    ttypes = dict(cur.fetchall())
+    out = [
+        (' '.join(ttypes[x] for x in cluster.tolist()), int(count))
+        for cluster, count in zip(clusters, counts)
+    ]
+    if sort == 'freq' or limit is not None:
+        out.sort(key=lambda x: (-x[1], x[0]))
+    if limit is not None:
+        out = out[:limit]
+    return out, totals
@@ -37,7 +37,13 @@ def stream_json(generator, header={}, cls=json.JSONEncoder):
 
     - ('footer', {x}): Include items in x after main results
     - ('header', {x}): Include items in x before main results
+    - ('ready', {x}): As header, but the caller can read the header now, before
+      any results are fetched (e.g. to set HTTP headers)
     - Anything else: Add to a "data" array
+
+    The first item yielded is None, once the generator has yielded 'ready' or
+    its first result (or finished). Any errors before then are raised, after
+    then they are added to the footer.
     """
     def format_header(header):
         header = json.dumps(header, separators=(',', ':'), sort_keys=True, cls=cls)
@@ -49,28 +55,36 @@ def stream_json(generator, header={}, cls=json.JSONEncoder):
         return header[:-1] + ',"data":['
 
     footer = {}
+    ready = False
     header_written = False
     try:
         for x in generator:
             if isinstance(x, tuple) and x[0] == 'footer':
                 footer.update(x[1])
-            elif isinstance(x, tuple) and x[0] == 'header':
+            elif isinstance(x, tuple) and x[0] in ('header', 'ready'):
                 header.update(x[1])
+                if x[0] == 'ready' and not ready:
+                    # Let the caller read this header now, e.g. to set HTTP headers
+                    yield None  # Nonsense item to consume and bin
+                    ready = True
             else:
                 if header_written:
                     yield ',\n' + json.dumps(x, separators=(',', ':'), cls=cls)
                 else:
-                    yield None  # Nonsense item to consume and bin
+                    if not ready:
+                        yield None  # Nonsense item to consume and bin
+                        ready = True
                     yield format_header(header)
                     yield '\n' + json.dumps(x, separators=(',', ':'), cls=cls)
                     header_written = True
     except Exception as e:
-        if not header_written:
+        if not ready:
             raise
         footer.update(format_error(e))
 
-    if not header_written:
+    if not ready:
         yield None  # Nonsense item to consume and bin
+    if not header_written:
         yield format_header(header)
 
     if len(footer) > 0:
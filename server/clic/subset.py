@@ -8,13 +8,15 @@ Returns subsets of given texts, for example quotations.
 - subset: subset to return, one of shortsus/longsus/nonquote/quote/all. Default 'all' (i.e. all text)
 - contextsize: Size of context window around subset. Default 0.
 - metadata: Optional data to return, see `book_metadata.py <db/book_metadata.py>`__ for all options.
+- limit: Maximum number of results to return. Default is to return everything.
+- continuation: Continue from where a previous ``limit``-ed request stopped.
 
 Parameters should be provided in querystring format, for example::
 
     ?corpora=dickens&corpora=AgnesG&subset=quote
 
 Returns a ``data`` array, one entry per result. The data array is sorted by the book id,
-then chapter number. Each item is an array with the following items:
+then position in the book. Each item is an array with the following items:
 
 * The left context window (if ``contextsize`` > 0, otherwise omitted)
 * The node (i.e. the subset)
@@ -45,6 +47,10 @@ Result metadata and Position-in-book metadata are currently subject to change.
 The ``version`` object gives both the current version of CLiC and the revision of the
 corpora ingested in the database.
 
+If ``limit`` was given and there are more results available, the footer will
+contain a ``continuation`` token. Repeat the request with this as the
+``continuation`` parameter to get the next page of results.
+
 Examples:
 
 /api/subset?corpora=AgnesG&subset=longsus::
@@ -79,12 +85,20 @@ The subset search peforms the following steps:
 1. Resolve the corpora option to a list of book IDs, translate the subset
    selection to a database region.
 
-2. For each region, find all tokens within the region, and (contextsize) + 10 characters
-   either side (it is faster to approximate the context's number of characters
-   than get (contextsize) words).
+2. Find all regions of that type in the books, in order. If a ``continuation``
+   is given, it contains the book_id, start character and region class of the
+   last region returned, and we start from the region after it. Regions are
+   indexed on ``(book_id, LOWER(crange), rclass_id)``, so each page is a range
+   scan of this index.
+
+3. For each region, fetch the tokens from (contextsize) before its first token
+   to (contextsize) after its last token. The first/last token of each region
+   is found at import time, so this is a range scan on ``(book_id, ordering)``.
+   Regions without any tokens in (e.g. empty suspensions) are skipped.
 
-3. Combine the results with the text from the original book, add the
-   chapter/paragraph/sentence statistics for the first node in the region, return result.
+4. Combine the text of each token, and the text between them, both stored when
+   importing, into concordance lines. Add the chapter/paragraph/sentence
+   statistics for the first node in the region, return result.
 
 Examples / edge cases
 ---------------------
@@ -131,28 +145,51 @@ Or nonquotes, from a single book::
     [['alice', 9, 'thought', 'Alice', 'to', 'herself'],
      ['alice', 231, 'Which', 'was', 'very', 'likely', 'true']]
 
-Context size can also be configured, but the return is only approximate::
+Context size can also be configured, in words either side::
 
     >>> format_conc(subset(db_cur, ['alice'], subset=['nonquote'], contextsize=[3]))
-    [['alice', 9, 'Well', '**', 'thought', 'Alice', 'to', 'herself', '**', 'after', 'such', 'a', 'fall', 'as', 'this', 'I'],
-     ['alice', 231, 'off', 'the', 'top', 'of', 'the', 'house', '**', 'Which', 'was', 'very', 'likely', 'true', '**']]
+    [['alice', 9, 'Well', '**', 'thought', 'Alice', 'to', 'herself', '**', 'after', 'such', 'a'],
+     ['alice', 231, 'of', 'the', 'house', '**', 'Which', 'was', 'very', 'likely', 'true', '**']]
 
 Suspensions without any words inside aren't returned::
 
     >>> format_conc(subset(db_cur, ['mansfield'], subset=['shortsus'], contextsize=[3]))
-    [['mansfield', 104, 'To', 'Parents', 'and', 'Guardians', '**', 'and', 'a', '**', 'Capital', 'season’d', 'Hunter']]
+    [['mansfield', 104, 'Parents', 'and', 'Guardians', '**', 'and', 'a', '**', 'Capital', 'season’d', 'Hunter']]
+
+Results can be returned a page at a time, using the continuation token in the
+footer to fetch the next page::
+
+    >>> out = list(subset(db_cur, ['alice', 'willows'], subset=['quote'], limit=[2]))
+    >>> format_conc(out)
+    [['alice', 1, 'Well'],
+     ['alice', 35, 'after', 'such', 'a', 'fall', 'as', 'this', 'I', 'shall',
+     'think', 'nothing', 'of', 'tumbling', 'down', 'stairs', 'How', 'brave',
+     'they’ll', 'all', 'think', 'me', 'at', 'home', 'Why', 'I', 'wouldn’t',
+     'say', 'anything', 'about', 'it', 'even', 'if', 'I', 'fell', 'off', 'the',
+     'top', 'of', 'the', 'house']]
+    >>> out = list(subset(db_cur, ['alice', 'willows'], subset=['quote'], limit=[2], continuation=[out[-1][1]['continuation']]))
+    >>> format_conc(out)
+    [['willows', 1, 'Get', 'off'],
+     ['willows', 54, 'Thought', 'I', 'should', 'find', 'you', 'here', 'all', 'right']]
+    >>> out = list(subset(db_cur, ['alice', 'willows'], subset=['quote'], limit=[2], continuation=[out[-1][1]['continuation']]))
+    >>> format_conc(out)
+    [['willows', 125, 'They', 'were', 'all', 'in', 'a', 'great', 'state', 'of',
+      'alarm', 'along', 'River', 'Bank', 'when', 'I', 'arrived', 'this', 'morning']]
+    >>> [x for x in out if isinstance(x, tuple)]  # No footer, so no more results
+    []
 
 """
-from clic.concordance import to_conc
+from clic.concordance import tokens_to_conc, parse_continuation
 
 from clic.db.book import get_book
 from clic.db.book_metadata import get_book_metadata
 from clic.db.corpora import corpora_to_book_ids
-from clic.db.lookup import api_subset_lookup, rclass_id_lookup
+from clic.db.cursor import server_side_rows
+from clic.db.lookup import api_subset_lookup
 from clic.errors import UserError
 
 
-def subset(cur, corpora=['dickens'], subset=['all'], contextsize=['0'], metadata=[]):
+def subset(cur, corpora=['dickens'], subset=['all'], contextsize=['0'], metadata=[], limit=[], continuation=[]):
     """
     Main entry function for subset search
 
@@ -161,60 +198,78 @@ def subset(cur, corpora=['dickens'], subset=['all'], contextsize=['0'], metadata
     - contextsize: Size of context window, defaults to none.
     - metadata, Array of extra metadata to provide with result, some of
       - 'book_titles' (return dict of book IDs to titles at end of result)
+    - limit: Maximum number of results to return, default unlimited
+    - continuation: Token from a previous request's footer, to resume after
     """
     book_ids = corpora_to_book_ids(cur, corpora)
     if len(book_ids) == 0:
         raise UserError("No books to search", "error")
     contextsize = int(contextsize[0])
     metadata = set(metadata)
+    limit = int(limit[0]) if limit else None
+    if limit is not None and limit < 1:
+        raise UserError("Limit must be at least 1", "error")
+    after = parse_continuation(continuation, 3) or (0, 0, 0)
+    next_continuation = None
     book_cur = cur.connection.cursor()
     book = None
     api_subset = api_subset_lookup(cur)
     rclass_ids = tuple(api_subset[s] for s in subset)
-    rclass = rclass_id_lookup(cur)
 
     query = """
         SELECT r.book_id
-             , c.full_tokens full_tokens
+             , r.rclass_id
+             , c.ttexts
+             , c.separators
              , c.is_node is_node
              , r.crange node_crange
-             , c.part_of part_of
+             , (SELECT ARRAY[t.chapter, t.paragraph, t.sentence] FROM token t WHERE t.book_id = r.book_id AND t.ordering = r.first_ordering) part_of
           FROM region r
           JOIN LATERAL (
-              SELECT COALESCE(ARRAY_AGG(t_surrounding.crange ORDER BY t_surrounding.book_id, t_surrounding.ordering), '{}'::INT4RANGE[]) full_tokens
-                   , COALESCE(ARRAY_AGG(t_surrounding.crange <@ r.crange ORDER BY t_surrounding.book_id, t_surrounding.ordering), '{}'::BOOL[]) is_node
-                   , (ARRAY_AGG(t_surrounding.part_of ORDER BY t_surrounding.book_id, t_surrounding.ordering))[1] part_of
+              SELECT ARRAY_AGG(t_surrounding.ttext ORDER BY t_surrounding.ordering) ttexts
+                   , ARRAY_AGG(t_surrounding.separator ORDER BY t_surrounding.ordering) separators
+                   , ARRAY_AGG(t_surrounding.ordering BETWEEN r.first_ordering AND r.last_ordering ORDER BY t_surrounding.ordering) is_node
                 FROM token t_surrounding
                WHERE t_surrounding.book_id = r.book_id
-                 AND t_surrounding.crange <@ range_expand(r.crange, %(contextsize)s)
+                 AND t_surrounding.ordering BETWEEN r.first_ordering - %(contextsize)s AND r.last_ordering + %(contextsize)s
                ) c ON TRUE
           WHERE r.book_id IN %(book_id)s
            AND r.rclass_id IN %(rclass_ids)s
+           AND (r.book_id, LOWER(r.crange), r.rclass_id) > %(after)s
+           AND r.first_ordering IS NOT NULL -- Ignore empty suspensions
+      ORDER BY r.book_id, LOWER(r.crange), r.rclass_id
     """
     params = dict(
         book_id=tuple(book_ids),
-        contextsize=contextsize * 10,  # TODO: Bodge word -> char
+        contextsize=contextsize,
         rclass_ids=rclass_ids,
+        after=after,
     )
-    cur.execute(query, params)
-
-    for book_id, full_tokens, is_node, node_crange, part_of in cur:
-        node_tokens = [crange for crange, include in zip(full_tokens, is_node) if include]
-        if len(node_tokens) == 0:
-            continue  # Ignore empty suspensions
+    if limit is not None:
+        # Fetch one more than we need, so we know if there's another page
+        query += "LIMIT %(limit)s\n"
+        params['limit'] = limit + 1
+    for book_id, rclass_id, ttexts, separators, is_node, node_crange, part_of in server_side_rows(cur, query, params):
+        if limit is not None:
+            if limit == 0:
+                # There's at least one more result, stop here
+                next_continuation = ':'.join(str(x) for x in after)
+                break
+            limit -= 1
+        after = (book_id, node_crange.lower, rclass_id)
+
+        node_start = is_node.index(True)
         if not book or book['id'] != book_id:
-            book = get_book(book_cur, book_id, content=True)
-        yield to_conc(book['content'], full_tokens, node_tokens, contextsize) + [
+            book = get_book(book_cur, book_id)
+        yield tokens_to_conc(ttexts, separators, node_start, node_start + sum(is_node), contextsize) + [
             [book['name'], node_crange.lower, node_crange.upper],
-            [
-                int(part_of.get(str(rclass['chapter.text']), -1)),
-                int(part_of.get(str(rclass['chapter.paragraph']), -1)),
-                int(part_of.get(str(rclass['chapter.sentence']), -1)),
-            ]
+            [-1 if x is None else x for x in part_of],
         ]
 
     book_cur.close()
 
     footer = get_book_metadata(cur, book_ids, metadata)
+    if next_continuation:
+        footer['continuation'] = next_continuation
     if footer:
         yield ('footer', footer)
@@ -30,8 +30,9 @@ Examples::
         ]
     }
 """
-from clic.db.book import get_book
+from clic.db.book import get_book_content
 from clic.db.corpora import corpora_to_book_ids
+from clic.db.cursor import server_side_rows
 from clic.db.lookup import rclass_id_lookup
 from clic.errors import UserError
 
@@ -47,9 +48,9 @@ def text(cur, corpora=[], regions=[]):
         raise UserError("Multiple books not supported", "error")
 
     for book_id in book_ids:
-        yield ('header', {'content': get_book(cur, book_id, content=True)['content']})
+        yield ('header', {'content': get_book_content(cur, book_id)})
 
-    cur.execute("""
+    for rclass_name, crange, rvalue in server_side_rows(cur, """
         SELECT (SELECT name FROM rclass WHERE rclass_id = r.rclass_id) rclass_name
              , r.crange
              , r.rvalue
@@ -59,7 +60,5 @@ def text(cur, corpora=[], regions=[]):
     """, dict(
         book_ids=book_ids,
         rclass_ids=rclass_ids,
-    ))
-
-    for rclass_name, crange, rvalue in cur:
+    )):
         yield [rclass_name, crange.lower, crange.upper, rvalue]
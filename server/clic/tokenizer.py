@@ -125,6 +125,25 @@ word in the unicode standard::
     ... had some reputation as a _connoisseur_.
     ... ''')]
     ['had', 'some', 'reputation', 'as', 'a', 'connoisseur']
+
+Separators
+----------
+
+The text between each token is stored along with it, split at the first
+whitespace. Concordances use this to decide which part belongs to the node,
+and which to the context window::
+
+    >>> split_separator(",' ")
+    (",'", ' ', '')
+    >>> split_separator('; "')
+    (';', ' ', '"')
+    >>> split_separator('.  ')
+    ('.', '  ', '')
+
+Separators without any whitespace aren't split::
+
+    >>> split_separator('--')
+    ('--', '', '')
 """
 import re
 
@@ -158,6 +177,8 @@ INITIAL_ABBREVIATIONS_REGEX = re.compile(r"^(?:%s)\W" % '|'.join(INITIAL_ABBREVI
 
 REGEX_WORD_REMOVALS = re.compile(r'^_|_$')
 
+RE_WHITESPACE = re.compile(r'(\s+)')  # Capture the whitespace so split returns it
+
 
 def word_boundary_type(s, bi, last_b, additional_word_parts=set()):
     """
@@ -235,3 +256,12 @@ def types_from_string(s, offset=0, additional_word_parts=set()):
     # Convert token list to types
     # NB: This needs to be developed in lock-step with client/lib/concordance_utils.js
     return (unidecode.unidecode(s.lower()) for s in out)
+
+
+def split_separator(s):
+    """
+    Split the text between 2 tokens at the first run of whitespace, returning
+    a tuple of (before, whitespace, after)
+    """
+    parts = RE_WHITESPACE.split(s, maxsplit=1)
+    return tuple(parts) if len(parts) == 3 else (s, '', '')
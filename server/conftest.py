@@ -1,6 +1,11 @@
+import os
 import unittest
 import pytest
 
+# NB: Test DB data is only visible to the test's own connection, so don't
+# borrow others from the pool. Tests that want workers set these themselves
+os.environ.setdefault('CONCORDANCE_WORKERS', '1')
+os.environ.setdefault('KEYWORD_WORKERS', '1')
 
 rpg = None
 
@@ -23,10 +28,15 @@ def test_database(**books):
     return rpg.pg_cur()
 
 
-def format_conc(conc_results):
-    """Turn concordance output into something slightly more human-readable"""
+def format_conc(conc_results, sort=True):
+    """
+    Turn concordance output into something slightly more human-readable.
+    Results are sorted, unless (sort) is False
+    """
     out = []
     for r in conc_results:
+        if isinstance(r, tuple):
+            continue  # Skip header / footer
         if len(r) == 3:
             out.append(
                 [r[1][0], r[1][1]] +
@@ -39,7 +49,8 @@ def format_conc(conc_results):
                 [r[1][i] for i in r[1][-1]] + ['**'] +
                 [r[2][i] for i in r[2][-1]]
             )
-    out.sort()
+    if sort:
+        out.sort()
     return out
 
 
@@ -26,6 +26,8 @@ ExecStart="${PROJECT_PATH}/server/bin/uwsgi" \
 WorkingDirectory=${PROJECT_PATH}/server
 DynamicUser=yes
 RuntimeDirectory=${PROJECT_NAME}
+CacheDirectory=${PROJECT_NAME}
+Environment=CACHE_DIR=/var/cache/${PROJECT_NAME}
 User=${API_USER}
 Group=${API_GROUP}
 Restart=on-failure
@@ -1,7 +1,12 @@
+import os
 import unittest
+import unittest.mock
 
+import flask
 from psycopg2._range import NumericRange
+from psycopg2.pool import PoolError
 
+from clic.app import create_app, to_view_func
 from clic.concordance import concordance, to_conc, parse_query
 
 from .requires_postgresql import RequiresPostgresql
@@ -31,6 +36,98 @@ class TestConcordance(RequiresPostgresql, unittest.TestCase):
             ['ut_conc_contextsize_1', 71, 'an', 'iron', '**', 'bar', '**'],  # NB: We have all 3 parts still, even though it's at the end
         ])
 
+    def put_search_books(self):
+        """Add books to search with conc(), returning a cursor and their names"""
+        self.search_cur = self.pg_cur()
+        self.put_books(
+            ut_conc_search_1="A man walked into a bar. It was an iron bar.",
+            ut_conc_search_2="The iron man walked into a bar.",
+            ut_conc_search_3="Another man, another bar.",
+        )
+        self.search_books = ['ut_conc_search_1', 'ut_conc_search_2', 'ut_conc_search_3']
+        return self.search_cur, self.search_books
+
+    def conc(self, **kwargs):
+        """Search the put_search_books() for 'bar' & 'man', returning the book & offset of each result"""
+        return [
+            r[1][:2] for r in concordance(self.search_cur, self.search_books, q=['bar', 'man'], **kwargs)
+            if not isinstance(r, tuple)
+        ]
+
+    def test_workers(self):
+        """Splitting books between workers gives the same results, in the same order"""
+        cur, books = self.put_search_books()
+        conc = self.conc
+        expected = conc()
+        self.assertEqual(len(expected), 7)
+        self.assertEqual(conc(limit=[4]), expected[:4])
+
+        # NB: Test DB data is only visible to our connection, so borrow extra cursors from it
+        extra_curs = []
+
+        def get_pool_cursor():
+            extra_curs.append(cur.connection.cursor())
+            return extra_curs[-1]
+        with unittest.mock.patch.dict(os.environ, CONCORDANCE_WORKERS='3', CURSOR_ITERSIZE='1'), \
+                unittest.mock.patch('clic.db.cursor.get_pool_cursor', side_effect=get_pool_cursor), \
+                unittest.mock.patch('clic.db.cursor.put_pool_cursor'):
+            self.assertEqual(conc(), expected)
+            self.assertEqual(conc(limit=[4]), expected[:4])
+        self.assertEqual(len(extra_curs), 2 + 2)
+
+        # If the pool is empty, we search all books with our own cursor
+        with unittest.mock.patch.dict(os.environ, CONCORDANCE_WORKERS='3'), \
+                unittest.mock.patch('clic.db.cursor.get_pool_cursor', side_effect=PoolError):
+            self.assertEqual(conc(), expected)
+
+        # Abandoning a search part-way through closes all the cursors, and the connection is still usable
+        with unittest.mock.patch.dict(os.environ, CONCORDANCE_WORKERS='3', CURSOR_ITERSIZE='1'), \
+                unittest.mock.patch('clic.db.cursor.get_pool_cursor', side_effect=get_pool_cursor), \
+                unittest.mock.patch('clic.db.cursor.put_pool_cursor'):
+            out = concordance(cur, books, q=['bar'])
+            next(out)
+            next(out)
+            out.close()
+        self.assertEqual(conc(), expected)
+
+    def test_itersize(self):
+        """Fetching a few rows at a time from the server-side cursor gives the same results"""
+        cur, books = self.put_search_books()
+        conc = self.conc
+        expected = conc()
+        self.assertEqual(len(expected), 7)
+
+        with unittest.mock.patch.dict(os.environ, CURSOR_ITERSIZE='2'):
+            self.assertEqual(conc(), expected)
+            self.assertEqual(conc(limit=[3]), expected[:3])
+
+        # Abandoning a search part-way through closes the cursor, and the connection is still usable
+        out = concordance(cur, books, q=['bar'])
+        next(out)
+        next(out)
+        out.close()
+        self.assertEqual(conc(), expected)
+
+    def test_estimated_hits_header(self):
+        """The estimated hits are sent as an HTTP header before any results are fetched"""
+        cur, books = self.put_search_books()
+        view_func = to_view_func(concordance, 'stream')['view_func']
+
+        def headers(query_string):
+            # NB: Test DB data is only visible to our connection, so don't use the pool
+            with unittest.mock.patch('clic.app.put_pool_cursor'), \
+                    create_app().test_request_context('/api/concordance?' + query_string):
+                flask.g.cur = cur.connection.cursor()
+                flask.g.clic_versions = {}
+                with unittest.mock.patch('clic.concordance.server_side_rows', side_effect=AssertionError):
+                    response = view_func()
+                response.close()
+                return response.headers
+        corpora = '&'.join('corpora=' + b for b in books)
+        self.assertEqual(headers(corpora + '&q=bar')['X-Estimated-Hits'], '4')
+        self.assertEqual(headers(corpora + '&q=bar&sort=L1')['X-Estimated-Hits'], '4')
+        self.assertEqual(headers(corpora + '&q=zebra')['X-Estimated-Hits'], '0')
+
 
 FULL_TEXT = 'A man walked into a bar. "Ouch!", he said. It was an iron bar.'
 R_A = NumericRange(0, 1)
@@ -111,6 +208,8 @@ def simplify(conc_results):
     """Turn concordance output into something slightly more human-readable"""
     out = []
     for r in conc_results:
+        if isinstance(r, tuple):
+            continue  # Skip header / footer
         if len(r) == 3:
             out.append(
                 [r[1][0], r[1][1]] +
@@ -1,8 +1,19 @@
+import os
+import shutil
+import tempfile
 import unittest
+import unittest.mock
 import pytest
 import pandas as pd
 
-from clic.keyword import log_likelihood, extract_keywords
+import clic.keyword
+from clic.cluster import get_word_list
+from clic.db.corpora import corpora_to_book_ids
+from clic.db.lookup import api_subset_lookup
+from clic.errors import UserError
+from clic.keyword import log_likelihood, extract_keywords, get_reference_word_list, word_list_df
+
+from .requires_postgresql import RequiresPostgresql
 
 
 class LogLikelihoodBasicTest(unittest.TestCase):
@@ -210,3 +221,179 @@ class KeywordExtraction(unittest.TestCase):
         value = keywords6.loc[0, 'LL']
         nr_of_decimals = len(str(value).split('.')[1])
         self.assertNotEqual(nr_of_decimals, 2)
+
+    def test_empty_reference(self):
+        keywords7 = extract_keywords(self.analysis,
+                                     self.reference.iloc[:0],
+                                     1000,
+                                     10000)
+        # nothing occurs in ref, so everything above the cut-off is a keyword
+        self.assertEqual(keywords7.Type.tolist(), ['one', 'three', 'four', 'five'])
+        self.assertEqual(keywords7.Count_ref.tolist(), [0, 0, 0, 0])
+        self.assertEqual(keywords7.index.tolist(), [0, 1, 2, 3])
+
+
+class TestReferenceWordList(RequiresPostgresql, unittest.TestCase):
+    def test_cache(self):
+        """Reference word lists are cached in memory & on disk, and match get_word_list"""
+        cur = self.pg_cur()
+        self.put_books(
+            ut_keyword_ref_1="A man walked into a bar. It was an iron bar.",
+            ut_keyword_ref_2="The iron man walked into a bar.",
+        )
+        book_ids = corpora_to_book_ids(cur, ['ut_keyword_ref_1', 'ut_keyword_ref_2'])
+        rclass_ids = (api_subset_lookup(cur)['all'],)
+
+        def word_list(clusterlength):
+            return get_reference_word_list(cur, book_ids, rclass_ids, clusterlength).reset_index(drop=True)
+
+        def expected(clusterlength):
+            return word_list_df(get_word_list(cur, book_ids, rclass_ids, clusterlength)[0])
+
+        with unittest.mock.patch.dict(os.environ, CACHE_DIR=tempfile.mkdtemp()):
+            clic.keyword._reference_word_lists.clear()
+            for clusterlength in (1, 2):
+                pd.testing.assert_frame_equal(word_list(clusterlength), expected(clusterlength))
+
+            # Second time round we don't need to fetch the word list
+            with unittest.mock.patch('clic.keyword.get_word_list', side_effect=AssertionError):
+                pd.testing.assert_frame_equal(word_list(1), expected(1))
+
+                # ...even if this process has forgotten it
+                clic.keyword._reference_word_lists.clear()
+                pd.testing.assert_frame_equal(word_list(2), expected(2))
+
+            # The types index is kept in memory along with the word list
+            self.assertIs(
+                get_reference_word_list(cur, book_ids, rclass_ids, 1).index,
+                get_reference_word_list(cur, book_ids, rclass_ids, 1).index,
+            )
+
+            # Empty word lists work too
+            self.assertEqual(len(word_list(20)), 0)
+
+
+#: Books for keyword tests, each with its own keyword
+KEYWORD_BOOKS = dict(
+    ut_keyword_1="The cat sat on the mat. The cat sat. The cat sat. The cat sat. The cat sat.",
+    ut_keyword_2="A dog sat on a log. The dog sat. The dog sat. The dog sat. The dog sat. The dog sat.",
+    ut_keyword_3="The man ran to the bar. The man ran. The man ran. The man ran. The man ran.",
+)
+
+
+class KeywordTestCase(RequiresPostgresql, unittest.TestCase):
+    """Adds KEYWORD_BOOKS, and gives each test an empty cache"""
+    books = sorted(KEYWORD_BOOKS.keys())
+
+    def setUp(self):
+        super(KeywordTestCase, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        env_patch = unittest.mock.patch.dict(os.environ, CACHE_DIR=self.cache_dir)
+        env_patch.start()
+        self.addCleanup(env_patch.stop)
+        clic.keyword._reference_word_lists.clear()
+
+        self.cur = self.pg_cur()
+        self.put_books(**KEYWORD_BOOKS)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        super(KeywordTestCase, self).tearDown()
+
+    def empty_cache(self):
+        """Forget any cached word lists, on disk and in memory"""
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        clic.keyword._reference_word_lists.clear()
+
+    def kw(self, **kwargs):
+        """Call keyword() for single words, with a p-value low enough to get some"""
+        return list(clic.keyword.keyword(self.cur, ['1'], ['0.5'], **kwargs))
+
+
+class TestKeywordRefmode(KeywordTestCase):
+    def test_rest(self):
+        """refmode=rest matches using the rest of the reference as the reference"""
+        kw = self.kw
+        everything = self.books
+        for subset, refsubset in (('all', 'all'), ('nonquote', 'all')):
+            for corpora in (['ut_keyword_1'], ['ut_keyword_1', 'ut_keyword_2']):
+                rest = [c for c in everything if c not in corpora]
+                out = kw(corpora=corpora, subset=[subset], refcorpora=everything, refsubset=[refsubset], refmode=['rest'])
+                self.assertEqual(out, kw(corpora=corpora, subset=[subset], refcorpora=rest, refsubset=[refsubset]))
+                self.assertIn('cat', [x[1] for x in out])
+                self.assertNotEqual(out, kw(corpora=corpora, subset=[subset], refcorpora=everything, refsubset=[refsubset]))
+
+        # Books not in the reference don't need taking away
+        self.assertEqual(
+            kw(corpora=['ut_keyword_1'], refcorpora=['ut_keyword_2'], refmode=['rest']),
+            kw(corpora=['ut_keyword_1'], refcorpora=['ut_keyword_2']),
+        )
+
+        with self.assertRaisesRegex(UserError, 'refmode'):
+            kw(corpora=['ut_keyword_1'], refmode=['parts'])
+
+    def test_workers(self):
+        """Fetching word lists in parallel gives the same results"""
+        cur = self.cur
+
+        def kw(**kwargs):
+            self.empty_cache()
+            return self.kw(corpora=['ut_keyword_1'], refcorpora=self.books, **kwargs)
+        expected = [kw(), kw(refmode=['rest']), kw(refmode=['rest'], refsubset=['nonquote'])]
+        self.assertIn('cat', [x[1] for x in expected[0]])
+
+        # NB: Test DB data is only visible to our connection, so borrow extra cursors from it
+        extra_curs = []
+
+        def get_pool_cursor():
+            extra_curs.append(cur.connection.cursor())
+            return extra_curs[-1]
+        with unittest.mock.patch.dict(os.environ, KEYWORD_WORKERS='3'), \
+                unittest.mock.patch('clic.db.cursor.get_pool_cursor', side_effect=get_pool_cursor), \
+                unittest.mock.patch('clic.db.cursor.put_pool_cursor'):
+            self.assertEqual([kw(), kw(refmode=['rest']), kw(refmode=['rest'], refsubset=['nonquote'])], expected)
+        self.assertEqual(len(extra_curs), 1 + 1 + 2)
+
+        # Once the reference word list is cached, we only need our own cursor
+        with unittest.mock.patch.dict(os.environ, KEYWORD_WORKERS='3'), \
+                unittest.mock.patch('clic.db.cursor.get_pool_cursor', side_effect=get_pool_cursor), \
+                unittest.mock.patch('clic.db.cursor.put_pool_cursor'):
+            self.assertEqual(kw(), expected[0])
+            extra_curs.clear()
+            self.assertEqual(self.kw(corpora=['ut_keyword_1'], refcorpora=self.books), expected[0])
+            clic.keyword._reference_word_lists.clear()  # i.e. read from disk
+            self.assertEqual(self.kw(corpora=['ut_keyword_1'], refcorpora=self.books), expected[0])
+        self.assertEqual(len(extra_curs), 0)
+
+
+class TestKeywordMatrix(KeywordTestCase):
+    def test_matches_keyword(self):
+        """Each book's keywords match keyword() against the rest of the books"""
+        cur = self.cur
+        self.put_books(ut_keyword_4="")
+        books = self.books + ['ut_keyword_4']
+
+        for clusterlength, pvalue in (('1', '0.5'), ('1', '0.05'), ('2', '0.5'), ('6', '0.5')):
+            out = list(clic.keyword.keyword_matrix(cur, clusterlength=[clusterlength], pvalue=[pvalue], corpora=books))
+            self.assertEqual([x[0] for x in out], books)
+            for name, total, keywords in out:
+                expected = [
+                    [k[1], k[2], k[4], k[8]]
+                    for k in clic.keyword.keyword(cur, [clusterlength], [pvalue], corpora=[name], refcorpora=books, refmode=['rest'])
+                    if not isinstance(k[0], str)
+                ]
+                self.assertEqual(sorted(keywords), sorted(expected))
+                self.assertEqual(keywords, sorted(keywords, key=lambda k: -k[3]))
+                self.assertEqual(total, sum(c for _, c in get_word_list(cur, corpora_to_book_ids(cur, [name]), (api_subset_lookup(cur)['all'],), int(clusterlength))[0]))
+
+        # Keywords are limited per book
+        out = list(clic.keyword.keyword_matrix(cur, pvalue=['0.5'], corpora=books, limit=['1']))
+        self.assertEqual([(x[0], [k[0] for k in x[2]]) for x in out], [
+            ('ut_keyword_1', ['cat']),
+            ('ut_keyword_2', ['dog']),
+            ('ut_keyword_3', ['man']),
+            ('ut_keyword_4', []),
+        ])
+
+        with self.assertRaisesRegex(UserError, 'at least 2 books'):
+            list(clic.keyword.keyword_matrix(cur, corpora=['ut_keyword_1']))
@@ -56,6 +56,43 @@ class Test_stream_json(unittest.TestCase):
             '{"a":1,"b":2,"data":[\r\n1\r,\n2\r,\n3\r\n]}'
         )
 
+    def test_ready(self):
+        """We're ready once 'ready' arrives, and can read the header before any results"""
+        progress = []
+
+        def fn():
+            progress.append('ready')
+            yield ('ready', dict(estimate=3))
+            progress.append('results')
+            yield 1
+            yield ('header', dict(later=True))
+        header = {}
+        sj_gen = stream_json(fn(), header)
+        self.assertIsNone(next(sj_gen))
+        self.assertEqual(progress, ['ready'])
+        self.assertEqual(header, dict(estimate=3))
+        self.assertEqual(json.loads("".join(sj_gen)), dict(estimate=3, data=[1]))
+
+    def test_errorafterready(self):
+        """Errors after 'ready' are written out"""
+        def fn():
+            yield ('ready', dict(estimate=3))
+            raise ValueError("Erk")
+
+        out = json.loads(self.sj(fn()))
+        self.assertEqual(out['estimate'], 3)
+        self.assertEqual(out['data'], [])
+        self.assertEqual(out['error']['message'], "ValueError: Erk")
+
+    def test_errorafterheader(self):
+        """Errors after a header, but before any results, are still thrown upwards"""
+        def fn():
+            yield ('header', dict(estimate=3))
+            raise ValueError("Erk")
+
+        with self.assertRaisesRegex(ValueError, "Erk"):
+            self.sj(fn())
+
     def test_initialerror(self):
         """Initial errors are thrown upwards to be handled"""
         def fn():
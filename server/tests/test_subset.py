@@ -25,6 +25,6 @@ class TestSubset(RequiresPostgresql, unittest.TestCase):
 
         out = simplify(subset(cur, ['ut_subs_emptyregion'], subset=['quote'], contextsize=[1]))
         self.assertEqual(out, [
-            ['ut_subs_emptyregion', 13, '**', 'What', 'do', 'you', 'have', 'to', 'say', 'to', 'that', 'then', '**', 'I', 'asked'],
+            ['ut_subs_emptyregion', 13, '**', 'What', 'do', 'you', 'have', 'to', 'say', 'to', 'that', 'then', '**', 'I'],
             # NB: Empty quote not included
         ])